@@ -1,3 +1,9 @@
-from importlib.metadata import version
+def __getattr__(name):
+    # Looking up the distribution metadata is slow, only do it when asked
+    if name == "__version__":
+        from importlib.metadata import version
 
-__version__ = version(__name__)
+        globals()["__version__"] = value = version(__name__)
+        return value
+
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
@@ -1,3 +1,4 @@
+#define PY_SSIZE_T_CLEAN
 #include <Python.h>
 #include "structmember.h"
 
@@ -12,6 +13,19 @@
 // About 24 days
 #define REBASE_TIME UINT32_MAX / 2
 
+/*
+    Free-threaded builds: each Rentry is only read or modified while holding
+    its own lock (a per-object critical section), so hits on distinct keys
+    never contend. The entries dict is thread-safe by itself, entries are
+    always retrieved as strong references.
+
+    With the GIL (or before 3.13), critical sections are no-ops.
+*/
+#ifndef Py_BEGIN_CRITICAL_SECTION
+#define Py_BEGIN_CRITICAL_SECTION(op) {
+#define Py_END_CRITICAL_SECTION() }
+#endif
+
 static uint64_t FAKE_NOW = 0;
 
 static PyObject *
@@ -60,6 +74,486 @@ static uint64_t naow(void) {
 #endif
 }
 
+/*
+    Monotonic clock in nanoseconds, for the instrumentation
+*/
+static uint64_t monotonic_ns(void) {
+#ifdef __APPLE__
+    static mach_timebase_info_data_t sTimebaseInfo;
+    if ( sTimebaseInfo.denom == 0 ) {
+        mach_timebase_info(&sTimebaseInfo);
+    }
+
+    return mach_absolute_time() * sTimebaseInfo.numer / sTimebaseInfo.denom;
+#elif defined(_WIN32)
+    static LARGE_INTEGER frequency;
+    LARGE_INTEGER counter;
+
+    if ( frequency.QuadPart == 0 ) {
+        QueryPerformanceFrequency(&frequency);
+    }
+    QueryPerformanceCounter(&counter);
+
+    return (uint64_t)((double)counter.QuadPart * 1e9 / frequency.QuadPart);
+#else
+    struct timespec timecheck;
+
+    clock_gettime(CLOCK_MONOTONIC, &timecheck);
+    return (uint64_t)timecheck.tv_sec * 1000000000 + (uint64_t)timecheck.tv_nsec;
+#endif
+}
+
+/*
+    HDR-style latency histogram (log-linear buckets)
+
+    Values below 2 * HIST_SUB are counted exactly, above that each power of
+    two range is split into HIST_SUB buckets: a value is known within 1.6%
+    whatever its magnitude, with a fixed memory and constant time record
+*/
+#define HIST_SUB_BITS 6
+#define HIST_SUB (1 << HIST_SUB_BITS)
+#define HIST_BUCKETS ((64 - HIST_SUB_BITS + 1) * HIST_SUB)
+
+typedef struct {
+    PyObject_HEAD
+
+    uint64_t count;
+    uint64_t total;
+    uint64_t min;
+    uint64_t max;
+    uint64_t counts[HIST_BUCKETS];
+} Histogram;
+
+static inline uint32_t
+Histogram_index(uint64_t value) {
+    if ( value < 2 * HIST_SUB ) {
+        return (uint32_t) value;
+    }
+
+#if defined(__GNUC__) || defined(__clang__)
+    uint32_t msb = 63 - __builtin_clzll(value);
+#else
+    uint32_t msb = 0;
+    while ( (value >> msb) > 1 ) {
+        msb++;
+    }
+#endif
+    uint32_t shift = msb - HIST_SUB_BITS;
+
+    return shift * HIST_SUB + (uint32_t)(value >> shift);
+}
+
+/*
+    Highest value counted in a bucket
+*/
+static inline uint64_t
+Histogram_upper(uint32_t index) {
+    uint32_t shift = index < 2 * HIST_SUB ? 0 : index / HIST_SUB - 1;
+    uint64_t sub = index - shift * HIST_SUB;
+
+    return ((sub + 1) << shift) - 1;
+}
+
+static void
+Histogram_add(Histogram *self, uint64_t value) {
+    Py_BEGIN_CRITICAL_SECTION(self);
+    self->counts[Histogram_index(value)]++;
+    if ( self->count == 0 || value < self->min ) {
+        self->min = value;
+    }
+    if ( value > self->max ) {
+        self->max = value;
+    }
+    self->count++;
+    self->total += value;
+    Py_END_CRITICAL_SECTION();
+}
+
+static PyObject *
+Histogram_record(Histogram *self, PyObject *arg) {
+    unsigned long long value = PyLong_AsUnsignedLongLong(arg);
+    if ( value == (unsigned long long)-1 && PyErr_Occurred() ) {
+        return NULL;
+    }
+
+    Histogram_add(self, value);
+    Py_RETURN_NONE;
+}
+
+/*
+    Value under which *percentile* % of the recorded values are
+    (the highest value of the bucket, bounded by the max recorded)
+*/
+static PyObject *
+Histogram_value_at(Histogram *self, PyObject *arg) {
+    double percentile = PyFloat_AsDouble(arg);
+    uint64_t result = 0;
+    uint32_t i;
+
+    if ( percentile == -1.0 && PyErr_Occurred() ) {
+        return NULL;
+    }
+
+    if ( percentile < 0.0 || percentile > 100.0 ) {
+        PyErr_SetString(PyExc_ValueError, "percentile must be between 0 and 100");
+        return NULL;
+    }
+
+    Py_BEGIN_CRITICAL_SECTION(self);
+    if ( self->count > 0 ) {
+        uint64_t seen = 0;
+        uint64_t target = (uint64_t)(percentile / 100.0 * self->count + 0.5);
+        if ( target < 1 ) {
+            target = 1;
+        }
+
+        for ( i = 0; i < HIST_BUCKETS; i++ ) {
+            seen += self->counts[i];
+            if ( seen >= target ) {
+                break;
+            }
+        }
+
+        result = Histogram_upper(i);
+        if ( result > self->max ) {
+            result = self->max;
+        }
+        if ( result < self->min ) {
+            result = self->min;
+        }
+    }
+    Py_END_CRITICAL_SECTION();
+
+    return PyLong_FromUnsignedLongLong(result);
+}
+
+static PyObject *
+Histogram_reset(Histogram *self, PyObject *Py_UNUSED(ignored)) {
+    Py_BEGIN_CRITICAL_SECTION(self);
+    memset(self->counts, 0, sizeof(self->counts));
+    self->count = self->total = self->min = self->max = 0;
+    Py_END_CRITICAL_SECTION();
+
+    Py_RETURN_NONE;
+}
+
+static PyMethodDef pyrated_Histogram_Methods[] = {
+    {"record", (PyCFunction)Histogram_record, METH_O,
+     "Count a (positive integer) value"},
+    {"value_at", (PyCFunction)Histogram_value_at, METH_O,
+     "Value under which {percentile} % of the recorded values are"},
+    {"reset", (PyCFunction)Histogram_reset, METH_NOARGS,
+     "Forget all the recorded values"},
+
+    {NULL}        /* Sentinel */
+};
+
+static PyMemberDef pyrated_Histogram_Members[] = {
+    {"count", T_ULONGLONG, offsetof(Histogram, count), READONLY,
+     "Number of recorded values"},
+    {"total", T_ULONGLONG, offsetof(Histogram, total), READONLY,
+     "Sum of the recorded values"},
+    {"min", T_ULONGLONG, offsetof(Histogram, min), READONLY,
+     "Lowest recorded value (0 if none)"},
+    {"max", T_ULONGLONG, offsetof(Histogram, max), READONLY,
+     "Highest recorded value (0 if none)"},
+    {NULL}  /* Sentinel */
+};
+
+static PyTypeObject pyrated_HistogramType = {
+    PyVarObject_HEAD_INIT(NULL, 0)
+    "pyrated._ratelimit.Histogram",  /* tp_name */
+    sizeof(Histogram),            /* tp_basicsize */
+    0,                            /* tp_itemsize */
+    0,                            /* tp_dealloc */
+    0,                            /* tp_print */
+    0,                            /* tp_getattr */
+    0,                            /* tp_setattr */
+    0,                            /* tp_reserved */
+    0,                            /* tp_repr */
+    0,                            /* tp_as_number */
+    0,                            /* tp_as_sequence */
+    0,                            /* tp_as_mapping */
+    0,                            /* tp_hash  */
+    0,                            /* tp_call */
+    0,                            /* tp_str */
+    0,                            /* tp_getattro */
+    0,                            /* tp_setattro */
+    0,                            /* tp_as_buffer */
+    Py_TPFLAGS_DEFAULT,           /* tp_flags */
+    "Latency histogram, values in nanoseconds by convention",  /* tp_doc */
+    0,                            /* tp_traverse */
+    0,                            /* tp_clear */
+    0,                            /* tp_richcompare */
+    0,                            /* tp_weaklistoffset */
+    0,                            /* tp_iter */
+    0,                            /* tp_iternext */
+    pyrated_Histogram_Methods,    /* tp_methods */
+    pyrated_Histogram_Members,    /* tp_members */
+    0,                            /* tp_getset */
+    0,                            /* tp_base */
+    0,                            /* tp_dict */
+    0,                            /* tp_descr_get */
+    0,                            /* tp_descr_set */
+    0,                            /* tp_dictoffset */
+    0,                            /* tp_init */
+    0,                            /* tp_alloc */
+    PyType_GenericNew,            /* tp_new */
+};
+
+/*
+    Pool of hit rings, owned by a RatelimitBase (and the entries using it)
+
+    Rings released by deleted or resized entries are kept in per-size free
+    lists, to be reused by new entries instead of going through the
+    allocator (and its zero-filling) again. Since all entries of a table
+    grow with the same policy, there are only a few distinct ring sizes.
+*/
+#define POOL_CLASSES 32
+#define POOL_CLASS_BYTES (4 * 1024 * 1024)  // Max memory kept per size class
+#define POOL_CLASS_MIN_RINGS 16
+
+typedef struct {
+    uint32_t size;    // Ring size (in number of hits) of this class
+    uint32_t nfree;   // Number of rings in *free
+    uint32_t max;     // Max number of rings kept
+    uint32_t **free;
+} RingClass;
+
+typedef struct {
+    PyObject_HEAD
+
+#ifdef Py_GIL_DISABLED
+    // Not a PyMutex: a contended PyMutex detaches the thread, which
+    // suspends the critical section of the entry being resized
+    PyThread_type_lock lock;
+#endif
+    uint32_t nclasses;
+    RingClass classes[POOL_CLASSES];
+
+    // Statistics
+    uint64_t allocated;  // Rings allocated from the system
+    uint64_t reused;     // Rings taken from the free lists
+    uint64_t released;   // Rings given back to the free lists
+    uint64_t freed;      // Rings given back to the system
+} RingPool;
+
+#ifdef Py_GIL_DISABLED
+#define POOL_LOCK(pool) PyThread_acquire_lock((pool)->lock, WAIT_LOCK)
+#define POOL_UNLOCK(pool) PyThread_release_lock((pool)->lock)
+#else
+#define POOL_LOCK(pool)
+#define POOL_UNLOCK(pool)
+#endif
+
+static RingClass *
+RingPool_class(RingPool *pool, uint32_t size, bool create) {
+    uint32_t i;
+
+    for ( i = 0; i < pool->nclasses; i++ ) {
+        if ( pool->classes[i].size == size ) {
+            return &pool->classes[i];
+        }
+    }
+
+    if ( !create || pool->nclasses == POOL_CLASSES ) {
+        return NULL;
+    }
+
+    RingClass *cls = &pool->classes[pool->nclasses++];
+    cls->size = size;
+    cls->nfree = 0;
+    cls->max = POOL_CLASS_BYTES / (size * sizeof(uint32_t));
+    if ( cls->max < POOL_CLASS_MIN_RINGS ) {
+        cls->max = POOL_CLASS_MIN_RINGS;
+    }
+    cls->free = NULL;
+
+    return cls;
+}
+
+/*
+    Get a ring of *size* hits, content is undefined
+*/
+static uint32_t *
+RingPool_get(RingPool *pool, uint32_t size) {
+    uint32_t *ring = NULL;
+
+    if ( pool != NULL ) {
+        POOL_LOCK(pool);
+        RingClass *cls = RingPool_class(pool, size, false);
+        if ( cls != NULL && cls->nfree > 0 ) {
+            ring = cls->free[--cls->nfree];
+            pool->reused++;
+        } else {
+            pool->allocated++;
+        }
+        POOL_UNLOCK(pool);
+    }
+
+    if ( ring == NULL ) {
+        ring = PyMem_New(uint32_t, size);
+    }
+
+    return ring;
+}
+
+/*
+    Give back a ring of *size* hits (may be NULL)
+*/
+static void
+RingPool_release(RingPool *pool, uint32_t *ring, uint32_t size) {
+    if ( ring == NULL ) {
+        return;
+    }
+
+    if ( pool != NULL ) {
+        bool kept = false;
+
+        POOL_LOCK(pool);
+        RingClass *cls = RingPool_class(pool, size, true);
+        if ( cls != NULL && cls->nfree < cls->max ) {
+            if ( cls->free == NULL ) {
+                cls->free = PyMem_New(uint32_t*, cls->max);
+            }
+            if ( cls->free != NULL ) {
+                cls->free[cls->nfree++] = ring;
+                kept = true;
+            }
+        }
+        if ( kept ) {
+            pool->released++;
+        } else {
+            pool->freed++;
+        }
+        POOL_UNLOCK(pool);
+
+        if ( kept ) {
+            return;
+        }
+    }
+
+    PyMem_Free(ring);
+}
+
+static PyObject *
+RingPool_new(PyTypeObject *type, PyObject *args, PyObject *kwds)
+{
+    RingPool *self = (RingPool *) type->tp_alloc(type, 0);
+    if ( self == NULL ) {
+        return NULL;
+    }
+
+#ifdef Py_GIL_DISABLED
+    self->lock = PyThread_allocate_lock();
+    if ( self->lock == NULL ) {
+        Py_DECREF(self);
+        return PyErr_NoMemory();
+    }
+#endif
+
+    return (PyObject *) self;
+}
+
+static void
+RingPool_dealloc(RingPool *self)
+{
+    uint32_t i, j;
+
+    for ( i = 0; i < self->nclasses; i++ ) {
+        RingClass *cls = &self->classes[i];
+        for ( j = 0; j < cls->nfree; j++ ) {
+            PyMem_Free(cls->free[j]);
+        }
+        PyMem_Free(cls->free);
+    }
+
+#ifdef Py_GIL_DISABLED
+    if ( self->lock != NULL ) {
+        PyThread_free_lock(self->lock);
+    }
+#endif
+
+    Py_TYPE(self)->tp_free((PyObject*)self);
+}
+
+static PyObject *
+RingPool_stats(RingPool *self, PyObject *Py_UNUSED(ignored)) {
+    unsigned long long allocated, reused, released, freed, cached = 0;
+    unsigned int nclasses;
+    uint32_t i;
+
+    // Copied first, no Python object is created while holding the lock
+    POOL_LOCK(self);
+    for ( i = 0; i < self->nclasses; i++ ) {
+        cached += self->classes[i].nfree;
+    }
+    allocated = self->allocated;
+    reused = self->reused;
+    released = self->released;
+    freed = self->freed;
+    nclasses = self->nclasses;
+    POOL_UNLOCK(self);
+
+    return Py_BuildValue(
+        "{sKsKsKsKsKsI}",
+        "allocated", allocated,
+        "reused", reused,
+        "released", released,
+        "freed", freed,
+        "cached", cached,
+        "classes", nclasses
+    );
+}
+
+static PyMethodDef pyrated_RingPool_Methods[] = {
+    {"stats", (PyCFunction)RingPool_stats, METH_NOARGS,
+     "Allocation statistics of the pool"},
+
+    {NULL}        /* Sentinel */
+};
+
+static PyTypeObject pyrated_RingPoolType = {
+    PyVarObject_HEAD_INIT(NULL, 0)
+    "pyrated._ratelimit.RingPool",  /* tp_name */
+    sizeof(RingPool),             /* tp_basicsize */
+    0,                            /* tp_itemsize */
+    (destructor)RingPool_dealloc, /* tp_dealloc */
+    0,                            /* tp_print */
+    0,                            /* tp_getattr */
+    0,                            /* tp_setattr */
+    0,                            /* tp_reserved */
+    0,                            /* tp_repr */
+    0,                            /* tp_as_number */
+    0,                            /* tp_as_sequence */
+    0,                            /* tp_as_mapping */
+    0,                            /* tp_hash  */
+    0,                            /* tp_call */
+    0,                            /* tp_str */
+    0,                            /* tp_getattro */
+    0,                            /* tp_setattro */
+    0,                            /* tp_as_buffer */
+    Py_TPFLAGS_DEFAULT,           /* tp_flags */
+    "pyrated pool of hit rings",  /* tp_doc */
+    0,                            /* tp_traverse */
+    0,                            /* tp_clear */
+    0,                            /* tp_richcompare */
+    0,                            /* tp_weaklistoffset */
+    0,                            /* tp_iter */
+    0,                            /* tp_iternext */
+    pyrated_RingPool_Methods,     /* tp_methods */
+    0,                            /* tp_members */
+    0,                            /* tp_getset */
+    0,                            /* tp_base */
+    0,                            /* tp_dict */
+    0,                            /* tp_descr_get */
+    0,                            /* tp_descr_set */
+    0,                            /* tp_dictoffset */
+    0,                            /* tp_init */
+    0,                            /* tp_alloc */
+    RingPool_new,                 /* tp_new */
+};
+
 typedef struct {
     PyObject_HEAD
 
@@ -67,6 +561,8 @@ typedef struct {
     uint32_t current;  // Current element in *hits
     uint32_t csize;    // Currently allocated *hits size
     uint32_t *hits;
+    RingPool *pool;    // Where *hits goes back to (NULL until the first hit)
+    uint32_t generation;  // Configuration of the table *hits is laid out for
 } Rentry;
 
 #if 0
@@ -98,6 +594,8 @@ Rentry_init(Rentry *self, PyObject *args, PyObject *kwds)
     self->current = 0;
     self->csize = 0;
     self->hits = NULL;
+    self->pool = NULL;
+    self->generation = 0;
 
     return 0;
 }
@@ -105,7 +603,8 @@ Rentry_init(Rentry *self, PyObject *args, PyObject *kwds)
 static void
 Rentry_dealloc(Rentry* self)
 {
-    PyMem_Free(self->hits);
+    RingPool_release(self->pool, self->hits, self->csize);
+    Py_XDECREF(self->pool);
     Py_TYPE(self)->tp_free((PyObject*)self);
 }
 
@@ -142,42 +641,59 @@ Rentry_maybe_rebase(Rentry* self, uint64_t now) {
     Rentry_rebase(self, now);
 }
 
+/*
+    Geometric growth of a ring, by at least bsize
+*/
+static inline uint64_t
+next_ring_size(uint32_t csize, uint32_t bsize, double growth) {
+    uint64_t new_size = (uint64_t)(csize * growth);
+
+    if ( new_size < (uint64_t)csize + bsize ) {
+        new_size = (uint64_t)csize + bsize;
+    }
+
+    return new_size;
+}
+
 /*
     Records a hit for that entry at current time.
     Returning FALSE if the ratelimit was reached, and TRUE if it was not.
 */
 static bool
-Rentry_hit(Rentry* self, uint32_t size, uint32_t period, uint32_t bsize) {
+Rentry_hit(Rentry* self, uint32_t size, uint32_t period, uint32_t bsize,
+           double growth, RingPool *pool) {
     uint64_t now = naow();
 
     if ( self->base == 0 ) {
         self->base = now - 1;
     }
 
+    if ( self->pool == NULL && pool != NULL ) {
+        Py_INCREF(pool);
+        self->pool = pool;
+    }
+
     if ( self->current == self->csize ) {
-        uint32_t i;
-        uint32_t new_size = (self->csize + bsize);
+        uint64_t new_size = next_ring_size(self->csize, bsize, growth);
         if ( new_size > size ) {
             // Don't allocate more than necessary
             new_size = size;
         }
 
         //printf("realloc %d -> %d\n", self->csize, new_size);
-        uint32_t* success = PyMem_Resize(self->hits, typeof(self->hits[0]), new_size);
-        if (success == NULL) {
-            return PyErr_NoMemory();
+        uint32_t* ring = RingPool_get(self->pool, new_size);
+        if (ring == NULL) {
+            PyErr_NoMemory();
+            return false;
         }
-        self->hits = success;
 
-        /*
-        // Unable to use memset properly
-        memset(self->hits + self->csize * sizeof(self->hits[0]),
-               0, (new_size - self->csize) * sizeof(self->hits[0]));
-        */
-        for ( i = self->csize; i < new_size; i++ ) {
-            self->hits[i] = 0;
+        if ( self->csize > 0 ) {
+            memcpy(ring, self->hits, self->csize * sizeof(ring[0]));
         }
+        memset(ring + self->csize, 0, (new_size - self->csize) * sizeof(ring[0]));
 
+        RingPool_release(self->pool, self->hits, self->csize);
+        self->hits = ring;
         self->csize = new_size;
     }
 
@@ -227,6 +743,128 @@ Rentry_next_hit(Rentry* self, uint32_t size, uint32_t period) {
     return 0;
 }
 
+/*
+    Returns how many hits were made within the last period
+    (hits are chronologically ordered in the ring, starting at *current*
+    once it has been filled)
+*/
+static void
+Rentry_chronology(Rentry* self, uint32_t *start, uint32_t *total) {
+    if ( self->current < self->csize && self->hits[self->current] != 0 ) {
+        // Wrapped around
+        *start = self->current;
+        *total = self->csize;
+    } else {
+        *start = 0;
+        *total = self->current;
+    }
+}
+
+static uint32_t
+Rentry_live_hits(Rentry* self, uint32_t period) {
+    uint32_t start, total;
+
+    Rentry_chronology(self, &start, &total);
+
+    if ( total == 0 ) {
+        return 0;
+    }
+
+    uint64_t now = naow();
+    Rentry_maybe_rebase(self, now);
+
+    now -= self->base;
+
+    // Binary search of the oldest hit still within the period
+    uint32_t low = 0, high = total;
+    while ( low < high ) {
+        uint32_t middle = low + (high - low) / 2;
+        uint32_t index = start + middle;
+        if ( index >= self->csize ) {
+            index -= self->csize;
+        }
+
+        if ( (now - self->hits[index]) < period ) {
+            high = middle;
+        } else {
+            low = middle + 1;
+        }
+    }
+
+    return total - low;
+}
+
+/*
+    Shrink the ring to *new_size*, only keeping the last *live* hits
+    (in a not wrapped around state)
+    Returns false if the new ring could not be allocated
+*/
+static bool
+Rentry_compact(Rentry* self, uint32_t live, uint32_t new_size) {
+    uint32_t start, total, i;
+    uint32_t *ring = NULL;
+
+    if ( new_size > 0 ) {
+        ring = RingPool_get(self->pool, new_size);
+        if ( ring == NULL ) {
+            return false;
+        }
+
+        Rentry_chronology(self, &start, &total);
+        for ( i = 0; i < live; i++ ) {
+            uint32_t index = start + (total - live) + i;
+            if ( index >= self->csize ) {
+                index -= self->csize;
+            }
+            ring[i] = self->hits[index];
+        }
+        memset(ring + live, 0, (new_size - live) * sizeof(ring[0]));
+    }
+
+    RingPool_release(self->pool, self->hits, self->csize);
+    self->hits = ring;
+    self->csize = new_size;
+    self->current = live;
+
+    return true;
+}
+
+/*
+    Lay out the ring again for a new count/period of the table: only the
+    hits still within the period (and at most *size*) are kept
+    Returns false if the new ring could not be allocated
+*/
+static bool
+Rentry_resize(Rentry* self, uint32_t size, uint32_t period, uint32_t bsize,
+              double growth) {
+    uint32_t live = Rentry_live_hits(self, period);
+    if ( live > size ) {
+        live = size;
+    }
+    if ( bsize == 0 ) {
+        bsize = 1;
+    }
+
+    uint64_t new_size = 0;
+    while ( new_size < live ) {
+        new_size = next_ring_size(new_size, bsize, growth);
+    }
+    if ( new_size > size ) {
+        new_size = size;
+    }
+
+    if ( !Rentry_compact(self, live, new_size) ) {
+        return false;
+    }
+
+    if ( live == size ) {
+        // Full ring, the oldest hit is at the start
+        self->current = 0;
+    }
+
+    return true;
+}
+
 #define STATE_VERSION 0
 #define STATE_BASE 1
 #define STATE_CURRENT 2
@@ -238,6 +876,11 @@ static PyObject *
 Rentry_get_state(Rentry* self) {
     PyObject *state, *tmp;
     state  = PyTuple_New(5);
+    if ( state == NULL ) {
+        return NULL;
+    }
+
+    Py_BEGIN_CRITICAL_SECTION(self);
 
     PyTuple_SetItem(state, STATE_VERSION,
         PyLong_FromUnsignedLong(1));
@@ -250,156 +893,502 @@ Rentry_get_state(Rentry* self) {
 
     tmp = PyBytes_FromStringAndSize((char*)self->hits, self->csize);
     PyTuple_SetItem(state, STATE_HITS, tmp);
+    Py_END_CRITICAL_SECTION();
 
     return state;
 }
 
-/* Re-set state from the get_state serialization */
+/* Re-set state from the get_state serialization */
+static PyObject *
+Rentry_set_state(Rentry* self, PyObject *args) {
+    PyObject *state;
+    if (! PyArg_ParseTuple(args, "O", &state) ) {
+        return NULL;
+    }
+
+    self->base = PyLong_AsLong(PyTuple_GetItem(state, STATE_BASE));
+    self->current = PyLong_AsLong(PyTuple_GetItem(state, STATE_CURRENT));
+    self->csize = PyLong_AsLong(PyTuple_GetItem(state, STATE_CSIZE));
+
+    self->hits = PyMem_Calloc(self->csize, sizeof(self->hits[0]));
+    if (self->hits == NULL) {
+        return PyErr_NoMemory();;
+    }
+    char *hits = PyBytes_AsString(PyTuple_GetItem(state, STATE_HITS));
+    memcpy(self->hits, hits, self->csize);
+
+    Py_RETURN_NONE;
+}
+
+static PyMethodDef pyrated_Rentry_Methods[] = {
+    {"__getstate__", (PyCFunction)Rentry_get_state, METH_NOARGS,
+     "Serialize function"},
+     {"__setstate__", (PyCFunction)Rentry_set_state, METH_VARARGS,
+     "Deserialize function"},
+
+      {NULL}        /* Sentinel */
+};
+
+static PyTypeObject pyrated_RentryType = {
+    PyVarObject_HEAD_INIT(NULL, 0)
+    "pyrated._ratelimit.Rentry",  /* tp_name */
+    sizeof(Rentry),               /* tp_basicsize */
+    0,                            /* tp_itemsize */
+    (destructor)Rentry_dealloc,   /* tp_dealloc */
+    0,                            /* tp_print */
+    0,                            /* tp_getattr */
+    0,                            /* tp_setattr */
+    0,                            /* tp_reserved */
+    0,                            /* tp_repr */
+    0,                            /* tp_as_number */
+    0,                            /* tp_as_sequence */
+    0,                            /* tp_as_mapping */
+    0,                            /* tp_hash  */
+    0,                            /* tp_call */
+    0,                            /* tp_str */
+    0,                            /* tp_getattro */
+    0,                            /* tp_setattro */
+    0,                            /* tp_as_buffer */
+    Py_TPFLAGS_DEFAULT,           /* tp_flags */
+    "pyrated Rentry objects",     /* tp_doc */
+    0,                            /* tp_traverse */
+    0,                            /* tp_clear */
+    0,                            /* tp_richcompare */
+    0,                            /* tp_weaklistoffset */
+    0,                            /* tp_iter */
+    0,                            /* tp_iternext */
+    pyrated_Rentry_Methods,       /* tp_methods */
+    0,                            /* tp_members */
+    0,                            /* tp_getset */
+    0,                            /* tp_base */
+    0,                            /* tp_dict */
+    0,                            /* tp_descr_get */
+    0,                            /* tp_descr_set */
+    0,                            /* tp_dictoffset */
+    (initproc)Rentry_init,        /* tp_init */
+    0,                            /* tp_alloc */
+    PyType_GenericNew,            /* tp_new */
+};
+
+typedef struct {
+    PyObject_HEAD
+
+    PyObject *entries;   // <dict> of str -> Rentry
+    uint32_t count;     // how many hits per...
+    uint32_t period;    // how many milliseconds
+    uint32_t block_size; // By how much entry->*hits will grow (at least) until it reaches max size
+    double growth;      // Geometric growth factor of entry->*hits
+    RingPool *pool;     // Recycled entry->*hits
+    Py_ssize_t compact_pos;  // Where the current compaction pass is in entries
+    uint32_t generation;  // Incremented at each reconfiguration
+
+    // Instrumentation, durations of hit/hit_many/get_many calls (one out of
+    // *sample*) and of cleanup/compact calls, only recorded when instrumented
+    char instrumented;
+    uint32_t sample;
+    uint32_t countdown;  // Calls left before the next timed one
+    Histogram *hit_histogram;
+    Histogram *cleanup_histogram;
+} RatelimitBase;
+
+static PyObject *
+RatelimitBase_new(PyTypeObject *type, PyObject *args, PyObject *kwds)
+{
+    RatelimitBase *self = (RatelimitBase *) type->tp_alloc(type, 0);
+    if ( self == NULL ) {
+        return NULL;
+    }
+
+    self->growth = 1.0;
+    self->sample = 1;
+    // Unlike the ones created by hits, unpickled entries need to be resized
+    self->generation = 1;
+    self->pool = (RingPool *) PyObject_CallObject((PyObject *) &pyrated_RingPoolType, NULL);
+    if ( self->pool == NULL ) {
+        Py_DECREF(self);
+        return NULL;
+    }
+
+    self->hit_histogram = (Histogram *) PyObject_CallObject((PyObject *) &pyrated_HistogramType, NULL);
+    self->cleanup_histogram = (Histogram *) PyObject_CallObject((PyObject *) &pyrated_HistogramType, NULL);
+    if ( self->hit_histogram == NULL || self->cleanup_histogram == NULL ) {
+        Py_DECREF(self);
+        return NULL;
+    }
+
+    return (PyObject *) self;
+}
+
+/*
+    Change the count and period of the table, the entries are resized
+    lazily, on their next use
+*/
+static PyObject *
+RatelimitBase_reconfigure(RatelimitBase *self, PyObject *args) {
+    Py_ssize_t count, period;
+
+    if (! PyArg_ParseTuple(args, "nn", &count, &period) ) {
+        return NULL;
+    }
+
+    if ( count <= 0 || period <= 0 || count > INT32_MAX || period > INT32_MAX ) {
+        PyErr_SetString(PyExc_ValueError, "count and period must be between 1 and 2**31 - 1");
+        return NULL;
+    }
+
+    self->count = count;
+    self->period = period;
+    self->generation++;
+
+    Py_RETURN_NONE;
+}
+
+static PyObject *
+RatelimitBase_pool_stats(RatelimitBase *self, PyObject *Py_UNUSED(ignored)) {
+    return RingPool_stats(self->pool, NULL);
+}
+
+
+/*
+    Retrieve the entry of a key in the table, creating it if need be
+    Returns a new reference, or NULL on error
+*/
+static Rentry *
+RatelimitBase_get_entry(RatelimitBase *self, PyObject *key) {
+    PyObject *value;
+#if PY_VERSION_HEX >= 0x030D0000
+    int found = PyDict_GetItemRef(self->entries, key, &value);
+    if ( found < 0 ) {
+        return NULL;
+    }
+
+    if ( found == 0 ) {
+        // Create new instance of Rentry
+        PyObject *entry = PyObject_CallObject((PyObject *) &pyrated_RentryType, NULL);
+        if ( entry == NULL ) {
+            return NULL;
+        }
+        ((Rentry*) entry)->generation = self->generation;
+
+        // Atomic: another thread may have created the entry in the meantime
+        found = PyDict_SetDefaultRef(self->entries, key, entry, &value);
+        Py_DECREF(entry);
+        if ( found < 0 ) {
+            return NULL;
+        }
+    }
+#else
+    value = PyDict_GetItemWithError(self->entries, key);
+
+    if ( value == NULL ) {
+        if ( PyErr_Occurred() ) {
+            return NULL;
+        }
+
+        // Create new instance of Rentry
+        value = PyObject_CallObject((PyObject *) &pyrated_RentryType, NULL);
+        if ( value == NULL ) {
+            return NULL;
+        }
+        ((Rentry*) value)->generation = self->generation;
+
+        if ( PyDict_SetItem(self->entries, key, value) < 0 ) {
+            Py_DECREF(value);
+            return NULL;
+        }
+    } else {
+        Py_INCREF(value);
+    }
+#endif
+
+    return (Rentry*) value;
+}
+
+/*
+    Retrieve the entry of a key in the table, without creating it
+    Returns a new reference, or NULL (with or without an exception set)
+*/
+static Rentry *
+RatelimitBase_find_entry(RatelimitBase *self, PyObject *key) {
+    PyObject *value;
+#if PY_VERSION_HEX >= 0x030D0000
+    if ( PyDict_GetItemRef(self->entries, key, &value) < 0 ) {
+        return NULL;
+    }
+#else
+    value = PyDict_GetItemWithError(self->entries, key);
+    Py_XINCREF(value);
+#endif
+
+    return (Rentry*) value;
+}
+
+/*
+    Resize the ring of an entry after a reconfiguration of the table, lazily
+    on its next use (the lock of the entry must be held)
+
+    *count* is the value of the table count the caller will use: in
+    free-threaded builds a reconfiguration may happen concurrently, a ring
+    must never be used with a count smaller than its size
+
+    Returns false (with an exception set) if the new ring could not be allocated
+*/
+static inline bool
+RatelimitBase_sync_entry(RatelimitBase *self, Rentry *entry, uint32_t count) {
+    if ( entry->generation == self->generation && entry->csize <= count ) {
+        return true;
+    }
+
+    if ( !Rentry_resize(entry, count, self->period, self->block_size,
+                        self->growth) ) {
+        PyErr_NoMemory();
+        return false;
+    }
+    entry->generation = self->generation;
+
+    return true;
+}
+
+/*
+    Rentry_hit, holding the lock of the entry
+*/
+static bool
+RatelimitBase_hit_entry(RatelimitBase *self, Rentry *entry) {
+    bool allowed = false;
+    uint32_t count = self->count;
+
+    Py_BEGIN_CRITICAL_SECTION(entry);
+    if ( RatelimitBase_sync_entry(self, entry, count) ) {
+        allowed = Rentry_hit(entry, count, self->period, self->block_size,
+                             self->growth, self->pool);
+    }
+    Py_END_CRITICAL_SECTION();
+
+    return allowed;
+}
+
+/*
+    Hit an entry in the table, creating it if need be
+*/
+static PyObject *
+RatelimitBase_hit_impl(RatelimitBase *self, PyObject *args) {
+    PyObject *key;
+
+    if (! PyArg_ParseTuple(args, "O", &key) ) {
+        return NULL;
+    }
+
+    Rentry *value = RatelimitBase_get_entry(self, key);
+    if ( value == NULL ) {
+        return NULL;
+    }
+
+    bool allowed = RatelimitBase_hit_entry(self, value);
+    Py_DECREF(value);
+
+    if ( allowed ) {
+        Py_RETURN_TRUE;
+    }
+
+    if ( PyErr_Occurred() ) {
+        return NULL;
+    }
+    Py_RETURN_FALSE;
+}
+
+/*
+    Batch version of hit, for a sequence of keys (that may contain duplicates)
+    Returns a list of booleans, in the same order as the keys
+*/
 static PyObject *
-Rentry_set_state(Rentry* self, PyObject *args) {
-    PyObject *state;
-    if (! PyArg_ParseTuple(args, "O", &state) ) {
+RatelimitBase_hit_many_impl(RatelimitBase *self, PyObject *keys) {
+    PyObject *seq = PySequence_Fast(keys, "hit_many expects a sequence of keys");
+    if ( seq == NULL ) {
         return NULL;
     }
 
-    self->base = PyLong_AsLong(PyTuple_GetItem(state, STATE_BASE));
-    self->current = PyLong_AsLong(PyTuple_GetItem(state, STATE_CURRENT));
-    self->csize = PyLong_AsLong(PyTuple_GetItem(state, STATE_CSIZE));
+    Py_ssize_t i, size = PySequence_Fast_GET_SIZE(seq);
+    PyObject **items = PySequence_Fast_ITEMS(seq);
 
-    self->hits = PyMem_Calloc(self->csize, sizeof(self->hits[0]));
-    if (self->hits == NULL) {
-        return PyErr_NoMemory();;
+    PyObject *result = PyList_New(size);
+    if ( result == NULL ) {
+        Py_DECREF(seq);
+        return NULL;
     }
-    char *hits = PyBytes_AsString(PyTuple_GetItem(state, STATE_HITS));
-    memcpy(self->hits, hits, self->csize);
-
-    Py_RETURN_NONE;
-}
-
-static PyMethodDef pyrated_Rentry_Methods[] = {
-    {"__getstate__", (PyCFunction)Rentry_get_state, METH_NOARGS,
-     "Serialize function"},
-     {"__setstate__", (PyCFunction)Rentry_set_state, METH_VARARGS,
-     "Deserialize function"},
 
-      {NULL}        /* Sentinel */
-};
+    for ( i = 0; i < size; i++ ) {
+        Rentry *value = RatelimitBase_get_entry(self, items[i]);
+        if ( value == NULL ) {
+            goto error;
+        }
 
-static PyTypeObject pyrated_RentryType = {
-    PyVarObject_HEAD_INIT(NULL, 0)
-    "pyrated._ratelimit.Rentry",  /* tp_name */
-    sizeof(Rentry),               /* tp_basicsize */
-    0,                            /* tp_itemsize */
-    (destructor)Rentry_dealloc,   /* tp_dealloc */
-    0,                            /* tp_print */
-    0,                            /* tp_getattr */
-    0,                            /* tp_setattr */
-    0,                            /* tp_reserved */
-    0,                            /* tp_repr */
-    0,                            /* tp_as_number */
-    0,                            /* tp_as_sequence */
-    0,                            /* tp_as_mapping */
-    0,                            /* tp_hash  */
-    0,                            /* tp_call */
-    0,                            /* tp_str */
-    0,                            /* tp_getattro */
-    0,                            /* tp_setattro */
-    0,                            /* tp_as_buffer */
-    Py_TPFLAGS_DEFAULT,           /* tp_flags */
-    "pyrated Rentry objects",     /* tp_doc */
-    0,                            /* tp_traverse */
-    0,                            /* tp_clear */
-    0,                            /* tp_richcompare */
-    0,                            /* tp_weaklistoffset */
-    0,                            /* tp_iter */
-    0,                            /* tp_iternext */
-    pyrated_Rentry_Methods,       /* tp_methods */
-    0,                            /* tp_members */
-    0,                            /* tp_getset */
-    0,                            /* tp_base */
-    0,                            /* tp_dict */
-    0,                            /* tp_descr_get */
-    0,                            /* tp_descr_set */
-    0,                            /* tp_dictoffset */
-    (initproc)Rentry_init,        /* tp_init */
-    0,                            /* tp_alloc */
-    PyType_GenericNew,            /* tp_new */
-};
+        bool allowed = RatelimitBase_hit_entry(self, value);
+        Py_DECREF(value);
+        if ( !allowed && PyErr_Occurred() ) {
+            goto error;
+        }
 
-typedef struct {
-    PyObject_HEAD
+        PyObject *ret = allowed ? Py_True : Py_False;
+        Py_INCREF(ret);
+        PyList_SET_ITEM(result, i, ret);
+    }
 
-    PyObject *entries;   // <dict> of str -> Rentry
-    uint32_t count;     // how many hits per...
-    uint32_t period;    // how many milliseconds
-    uint32_t block_size; // By how much entry->*hits will grow until it reaches max size
-} RatelimitBase;
+    Py_DECREF(seq);
+    return result;
 
+error:
+    Py_DECREF(seq);
+    Py_DECREF(result);
+    return NULL;
+}
 
 /*
-    Hit an entry in the table, creating it if need be
+    Table version of the Rentry_next_hit call (do not create new entries)
 */
 static PyObject *
-RatelimitBase_hit(RatelimitBase *self, PyObject *args) {
+RatelimitBase_next_hit(RatelimitBase *self, PyObject *args) {
     PyObject *key;
 
     if (! PyArg_ParseTuple(args, "O", &key) ) {
         return NULL;
     }
 
-    Rentry *value = (Rentry*) PyDict_GetItem(self->entries, key);
+    Rentry *value = RatelimitBase_find_entry(self, key);
 
     if ( value == NULL ) {
-        // Create new instance of Rentry
-        value = (Rentry*) PyObject_CallObject((PyObject *) &pyrated_RentryType, NULL);
-
-        PyDict_SetItem(self->entries, key,  (PyObject*) value);
+        if ( PyErr_Occurred() ) {
+            return NULL;
+        }
+        return PyLong_FromUnsignedLong(0);
+    }
 
-        // Let the dict keep the ownership
-        Py_DECREF(value);
+    uint64_t result = 0;
+    uint32_t count = self->count;
+    bool synced;
+    Py_BEGIN_CRITICAL_SECTION(value);
+    synced = RatelimitBase_sync_entry(self, value, count);
+    if ( synced ) {
+        result = Rentry_next_hit(value, count, self->period);
     }
+    Py_END_CRITICAL_SECTION();
+    Py_DECREF(value);
 
-    if (Rentry_hit(value, self->count, self->period, self->block_size)) {
-        Py_RETURN_TRUE;
-    } else {
-        Py_RETURN_FALSE;
+    if ( !synced ) {
+        return NULL;
     }
+
+    return PyLong_FromUnsignedLong(result);
 }
 
 /*
-    Table version of the Rentry_next_hit call (do not create new entries)
+    For each key of a sequence, returns a (exists, remaining, next_hit) tuple
+    with a single lookup: whether the entry exists, how many hits are
+    still allowed right now and for how many milliseconds hit() will
+    reply with False (do not create new entries)
 */
 static PyObject *
-RatelimitBase_next_hit(RatelimitBase *self, PyObject *args) {
-    PyObject *key;
+RatelimitBase_get_many_impl(RatelimitBase *self, PyObject *keys) {
+    PyObject *seq = PySequence_Fast(keys, "get_many expects a sequence of keys");
+    if ( seq == NULL ) {
+        return NULL;
+    }
 
-    if (! PyArg_ParseTuple(args, "O", &key) ) {
+    Py_ssize_t i, size = PySequence_Fast_GET_SIZE(seq);
+    PyObject **items = PySequence_Fast_ITEMS(seq);
+
+    PyObject *result = PyList_New(size);
+    if ( result == NULL ) {
+        Py_DECREF(seq);
         return NULL;
     }
 
-    Rentry *value = (Rentry*) PyDict_GetItem(self->entries, key);
+    for ( i = 0; i < size; i++ ) {
+        Rentry *value = RatelimitBase_find_entry(self, items[i]);
+        PyObject *item;
 
-    if ( value == NULL ) {
-        return PyLong_FromUnsignedLong(0);
+        if ( value == NULL ) {
+            if ( PyErr_Occurred() ) {
+                goto error;
+            }
+            item = Py_BuildValue("(OkK)", Py_False, (unsigned long)self->count, 0ULL);
+        } else {
+            uint32_t live = 0;
+            uint32_t count = self->count;
+            uint64_t next = 0;
+            bool synced;
+
+            Py_BEGIN_CRITICAL_SECTION(value);
+            synced = RatelimitBase_sync_entry(self, value, count);
+            if ( synced ) {
+                live = Rentry_live_hits(value, self->period);
+                next = Rentry_next_hit(value, count, self->period);
+            }
+            Py_END_CRITICAL_SECTION();
+            Py_DECREF(value);
+
+            if ( !synced ) {
+                goto error;
+            }
+
+            item = Py_BuildValue("(OkK)", Py_True,
+                                 (unsigned long)(count - live),
+                                 (unsigned long long)next);
+        }
+
+        if ( item == NULL ) {
+            goto error;
+        }
+        PyList_SET_ITEM(result, i, item);
     }
 
-    uint64_t result = Rentry_next_hit(value, self->count, self->period);
+    Py_DECREF(seq);
+    return result;
 
-    return PyLong_FromUnsignedLong(result);
+error:
+    Py_DECREF(seq);
+    Py_DECREF(result);
+    return NULL;
+}
+
+/*
+    Whether an entry had no hit for the whole period
+*/
+static bool
+Rentry_expired(Rentry *entry, uint32_t period, uint64_t now) {
+    bool expired;
+
+    Py_BEGIN_CRITICAL_SECTION(entry);
+    if ( entry->csize == 0 ) {
+        expired = true;
+    } else {
+        uint32_t index =
+            entry->current == 0 ? entry->csize - 1 : entry->current - 1;
+        uint64_t expires_at = entry->base + entry->hits[index] + period;
+
+        expired = expires_at <= now;
+    }
+    Py_END_CRITICAL_SECTION();
+
+    return expired;
 }
 
 /*
     Cleanup entries in the table that have expired
     (no hit since the total period)
+
+    Free-threaded builds: an expired entry hit by another thread right
+    before its removal only loses that hit
 */
 static PyObject *
-RatelimitBase_cleanup(RatelimitBase *self, PyObject *args) {
+RatelimitBase_cleanup_impl(RatelimitBase *self, PyObject *args) {
     PyObject *key, *value = NULL;
     Py_ssize_t pos = 0;
 
     const uint32_t BSIZE = 512; // Allocation block size for to_delete array
     uint32_t size = BSIZE;
     uint32_t count = 0;
+    uint32_t i;
+    bool failed = false;
 
     PyObject **to_delete = PyMem_Calloc(sizeof(PyObject*), size);
 
@@ -409,47 +1398,211 @@ RatelimitBase_cleanup(RatelimitBase *self, PyObject *args) {
 
     const uint64_t now = naow();
 
+    Py_BEGIN_CRITICAL_SECTION(self->entries);
     while (PyDict_Next(self->entries, &pos, &key, &value)) {
-        Rentry *entry = (Rentry*) value;
-
-        if ( entry->csize == 0 ) {
-            // Remove entry
-        } else {
-            uint32_t index =
-                entry->current == 0 ? entry->csize - 1 : entry->current - 1;
-            uint64_t expires_at = entry->base + entry->hits[index] + self->period;
+        // Strong references: locking the entry may suspend the lock of the
+        // table (nested critical section), and another thread could then
+        // remove them. Keys are also deleted after the iteration
+        Py_INCREF(key);
+        Py_INCREF(value);
+        bool expired = Rentry_expired((Rentry*) value, self->period, now);
+        Py_DECREF(value);
 
-            if ( expires_at <= now ) {
-                // Remove entry
-            } else {
-                // SKIP
-                continue;
-            }
+        if ( !expired ) {
+            Py_DECREF(key);
+            continue;
         }
 
         // Bounds of array reached
         if ( count == size ) {
+            PyObject **resized = PyMem_Resize(to_delete, PyObject*, size + BSIZE);
+            if ( resized == NULL ) {
+                Py_DECREF(key);
+                failed = true;
+                break;
+            }
+            to_delete = resized;
             size += BSIZE;
-            // XXX check for failed call
-            to_delete = realloc(to_delete, size * sizeof(PyObject*));
         }
+
         to_delete[count++] = key;
     }
+    Py_END_CRITICAL_SECTION();
 
-    uint32_t i;
+    uint32_t deleted = 0;
     for ( i = 0; i < count; i++ ) {
-        PyDict_DelItem(self->entries, to_delete[i]);
+        if ( !failed ) {
+            if ( PyDict_DelItem(self->entries, to_delete[i]) == 0 ) {
+                deleted++;
+            } else {
+                // Already removed (by another thread)
+                PyErr_Clear();
+            }
+        }
+        Py_DECREF(to_delete[i]);
     }
     PyMem_Free(to_delete);
 
-    return PyLong_FromLong((long)count);
+    if ( failed ) {
+        return PyErr_NoMemory();
+    }
+
+    return PyLong_FromLong((long)deleted);
+}
+
+
+/*
+    Compact the rings of up to *budget* entries, continuing where the
+    previous call stopped: a ring is shrunk to the smallest size of the
+    growth policy that fits its live hits, when that size is at most half
+    of the current one (so a ring is not reallocated for a few slots)
+
+    Returns the number of entries visited, and compacted. A whole pass over
+    the table is done once less than *budget* entries were visited
+*/
+static PyObject *
+RatelimitBase_compact_impl(RatelimitBase *self, PyObject *args) {
+    Py_ssize_t budget, visited = 0;
+    uint32_t compacted = 0;
+    PyObject *key, *value = NULL;
+    bool failed = false;
+
+    if (! PyArg_ParseTuple(args, "n", &budget) ) {
+        return NULL;
+    }
+
+    const uint32_t bsize = self->block_size > 0 ? self->block_size : 1;
+
+    Py_BEGIN_CRITICAL_SECTION(self->entries);
+    Py_ssize_t pos = self->compact_pos;
+
+    while ( visited < budget ) {
+        if ( !PyDict_Next(self->entries, &pos, &key, &value) ) {
+            pos = 0;
+            break;
+        }
+        visited++;
+
+        // Strong reference, the nested critical section may suspend the
+        // lock of the table (another thread could then remove the entry)
+        Rentry *entry = (Rentry*) value;
+        Py_INCREF(entry);
+
+        uint32_t count = self->count;
+
+        Py_BEGIN_CRITICAL_SECTION(entry);
+        if ( entry->generation != self->generation || entry->csize > count ) {
+            // Resized (so compacted) after a reconfiguration
+            failed = !RatelimitBase_sync_entry(self, entry, count);
+            compacted += !failed;
+        } else {
+            uint32_t live = Rentry_live_hits(entry, self->period);
+
+            uint64_t new_size = 0;
+            while ( new_size < live ) {
+                new_size = next_ring_size(new_size, bsize, self->growth);
+            }
+            if ( new_size > count ) {
+                new_size = count;
+            }
+
+            if ( entry->csize > 0 && new_size * 2 <= entry->csize ) {
+                if ( Rentry_compact(entry, live, new_size) ) {
+                    compacted++;
+                } else {
+                    failed = true;
+                }
+            }
+        }
+        Py_END_CRITICAL_SECTION();
+        Py_DECREF(entry);
+
+        if ( failed ) {
+            break;
+        }
+    }
+
+    self->compact_pos = pos;
+    Py_END_CRITICAL_SECTION();
+
+    if ( failed ) {
+        return PyErr_NoMemory();
+    }
+
+    return Py_BuildValue("(nI)", visited, compacted);
+}
+
+#ifdef Py_GIL_DISABLED
+// The countdown is shared by all threads, only the sampling rate is
+// approximate when they race
+#define COUNTDOWN_LOAD(self) _Py_atomic_load_uint32_relaxed(&(self)->countdown)
+#define COUNTDOWN_STORE(self, value) \
+    _Py_atomic_store_uint32_relaxed(&(self)->countdown, (value))
+#else
+#define COUNTDOWN_LOAD(self) ((self)->countdown)
+#define COUNTDOWN_STORE(self, value) ((self)->countdown = (value))
+#endif
+
+/*
+    Instrumentation: call *impl*, recording its duration when enabled
+    (for one call out of self->sample when *sampled*, those are the
+    frequent and short ones: timing them all would double their cost)
+*/
+static inline PyObject *
+RatelimitBase_timed(RatelimitBase *self, Histogram *histogram, bool sampled,
+                    PyObject *(*impl)(RatelimitBase *, PyObject *), PyObject *arg) {
+    if ( !self->instrumented ) {
+        return impl(self, arg);
+    }
+
+    if ( sampled ) {
+        uint32_t countdown = COUNTDOWN_LOAD(self);
+        if ( countdown > 1 ) {
+            COUNTDOWN_STORE(self, countdown - 1);
+            return impl(self, arg);
+        }
+        COUNTDOWN_STORE(self, self->sample);
+    }
+
+    uint64_t start = monotonic_ns();
+    PyObject *result = impl(self, arg);
+    Histogram_add(histogram, monotonic_ns() - start);
+
+    return result;
+}
+
+static PyObject *
+RatelimitBase_hit(RatelimitBase *self, PyObject *args) {
+    return RatelimitBase_timed(self, self->hit_histogram, true, RatelimitBase_hit_impl, args);
+}
+
+static PyObject *
+RatelimitBase_hit_many(RatelimitBase *self, PyObject *keys) {
+    return RatelimitBase_timed(self, self->hit_histogram, true, RatelimitBase_hit_many_impl, keys);
+}
+
+static PyObject *
+RatelimitBase_get_many(RatelimitBase *self, PyObject *keys) {
+    return RatelimitBase_timed(self, self->hit_histogram, true, RatelimitBase_get_many_impl, keys);
+}
+
+static PyObject *
+RatelimitBase_cleanup(RatelimitBase *self, PyObject *args) {
+    return RatelimitBase_timed(self, self->cleanup_histogram, false, RatelimitBase_cleanup_impl, args);
 }
 
+static PyObject *
+RatelimitBase_compact(RatelimitBase *self, PyObject *args) {
+    return RatelimitBase_timed(self, self->cleanup_histogram, false, RatelimitBase_compact_impl, args);
+}
 
 static void
 RatelimitBase_dealloc(RatelimitBase* self)
 {
     Py_XDECREF(self->entries);
+    Py_XDECREF(self->pool);
+    Py_XDECREF(self->hit_histogram);
+    Py_XDECREF(self->cleanup_histogram);
     Py_TYPE(self)->tp_free((PyObject*)self);
 }
 
@@ -475,10 +1628,23 @@ static PyMethodDef pyrated_RatelimitBase_Methods[] = {
     {"hit",  (PyCFunction)RatelimitBase_hit, METH_VARARGS,
      "\"hit\" the ratelimit for a specific key, will return True if rate is "
      "within the current limits specifications for that key"},
+    {"hit_many",  (PyCFunction)RatelimitBase_hit_many, METH_O,
+     "hit() a sequence of keys at once, returning a list of the results"},
     {"next_hit",  (PyCFunction)RatelimitBase_next_hit, METH_VARARGS,
      "For how many milliseconds hit() will reply with False"},
+    {"get_many",  (PyCFunction)RatelimitBase_get_many, METH_O,
+     "For a sequence of keys, returns a list of (exists, remaining hits, "
+     "next_hit) tuples"},
     {"cleanup", (PyCFunction)RatelimitBase_cleanup, METH_NOARGS,
      "Remove expired entries from the list"},
+    {"compact", (PyCFunction)RatelimitBase_compact, METH_VARARGS,
+     "Shrink the memory of up to {budget} entries with few recent hits, "
+     "returns the (visited, compacted) numbers of entries"},
+    {"_reconfigure", (PyCFunction)RatelimitBase_reconfigure, METH_VARARGS,
+     "Set the {count} and {period} (milliseconds) of the table, "
+     "existing entries are resized on their next use"},
+    {"_pool_stats", (PyCFunction)RatelimitBase_pool_stats, METH_NOARGS,
+     "Allocation statistics of the hits memory"},
 
     {NULL}        /* Sentinel */
 };
@@ -492,6 +1658,16 @@ static PyMemberDef pyrated_RatelimitBase_Members[] = {
      "The period (in milliseconds) over which the hits are allowed"},
     {"_block_size", T_INT, offsetof(RatelimitBase, block_size), 0,
      "Allocation block size"},
+    {"_growth", T_DOUBLE, offsetof(RatelimitBase, growth), 0,
+     "Allocation growth factor"},
+    {"_instrumented", T_BOOL, offsetof(RatelimitBase, instrumented), 0,
+     "Whether the durations of calls are recorded"},
+    {"_sample", T_UINT, offsetof(RatelimitBase, sample), 0,
+     "Only one hit, hit_many or get_many call out of that many is timed"},
+    {"_hit_histogram", T_OBJECT, offsetof(RatelimitBase, hit_histogram), READONLY,
+     "Durations of the hit, hit_many and get_many calls (nanoseconds)"},
+    {"_cleanup_histogram", T_OBJECT, offsetof(RatelimitBase, cleanup_histogram), READONLY,
+     "Durations of the cleanup and compact calls (nanoseconds)"},
     {NULL}  /* Sentinel */
 };
 
@@ -534,15 +1710,165 @@ static PyTypeObject pyrated_RatelimitBaseType = {
     0,                            /* tp_dictoffset */
     NULL,                         /* tp_init */
     0,                            /* tp_alloc */
-    PyType_GenericNew,            /* tp_new */
+    RatelimitBase_new,            /* tp_new */
 };
 
+/*
+    XXH64 hash (https://github.com/Cyan4973/xxHash), used to replace
+    arbitrary long keys by fixed size integers
+*/
+#define XXH_PRIME64_1 11400714785074694791ULL
+#define XXH_PRIME64_2 14029467366897019727ULL
+#define XXH_PRIME64_3 1609587929392839161ULL
+#define XXH_PRIME64_4 9650029242287828579ULL
+#define XXH_PRIME64_5 2870177450012600261ULL
+
+#define XXH_ROTL64(x, r) (((x) << (r)) | ((x) >> (64 - (r))))
+
+static inline uint64_t
+xxh_read64(const uint8_t *p) {
+    return (uint64_t)p[0] | ((uint64_t)p[1] << 8) | ((uint64_t)p[2] << 16)
+        | ((uint64_t)p[3] << 24) | ((uint64_t)p[4] << 32)
+        | ((uint64_t)p[5] << 40) | ((uint64_t)p[6] << 48)
+        | ((uint64_t)p[7] << 56);
+}
+
+static inline uint32_t
+xxh_read32(const uint8_t *p) {
+    return (uint32_t)p[0] | ((uint32_t)p[1] << 8) | ((uint32_t)p[2] << 16)
+        | ((uint32_t)p[3] << 24);
+}
+
+static inline uint64_t
+xxh_round(uint64_t acc, uint64_t input) {
+    acc += input * XXH_PRIME64_2;
+    acc = XXH_ROTL64(acc, 31);
+    return acc * XXH_PRIME64_1;
+}
+
+static inline uint64_t
+xxh_merge_round(uint64_t acc, uint64_t val) {
+    acc ^= xxh_round(0, val);
+    return acc * XXH_PRIME64_1 + XXH_PRIME64_4;
+}
+
+static uint64_t
+xxh64(const uint8_t *p, size_t len, uint64_t seed) {
+    const uint8_t *end = p + len;
+    uint64_t h;
+
+    if ( len >= 32 ) {
+        const uint8_t *limit = end - 32;
+        uint64_t v1 = seed + XXH_PRIME64_1 + XXH_PRIME64_2;
+        uint64_t v2 = seed + XXH_PRIME64_2;
+        uint64_t v3 = seed;
+        uint64_t v4 = seed - XXH_PRIME64_1;
+
+        do {
+            v1 = xxh_round(v1, xxh_read64(p));
+            v2 = xxh_round(v2, xxh_read64(p + 8));
+            v3 = xxh_round(v3, xxh_read64(p + 16));
+            v4 = xxh_round(v4, xxh_read64(p + 24));
+            p += 32;
+        } while ( p <= limit );
+
+        h = XXH_ROTL64(v1, 1) + XXH_ROTL64(v2, 7) + XXH_ROTL64(v3, 12)
+            + XXH_ROTL64(v4, 18);
+        h = xxh_merge_round(h, v1);
+        h = xxh_merge_round(h, v2);
+        h = xxh_merge_round(h, v3);
+        h = xxh_merge_round(h, v4);
+    } else {
+        h = seed + XXH_PRIME64_5;
+    }
+
+    h += (uint64_t) len;
+
+    while ( p + 8 <= end ) {
+        h ^= xxh_round(0, xxh_read64(p));
+        h = XXH_ROTL64(h, 27) * XXH_PRIME64_1 + XXH_PRIME64_4;
+        p += 8;
+    }
+
+    if ( p + 4 <= end ) {
+        h ^= (uint64_t) xxh_read32(p) * XXH_PRIME64_1;
+        h = XXH_ROTL64(h, 23) * XXH_PRIME64_2 + XXH_PRIME64_3;
+        p += 4;
+    }
+
+    while ( p < end ) {
+        h ^= (*p) * XXH_PRIME64_5;
+        h = XXH_ROTL64(h, 11) * XXH_PRIME64_1;
+        p++;
+    }
+
+    h ^= h >> 33;
+    h *= XXH_PRIME64_2;
+    h ^= h >> 29;
+    h *= XXH_PRIME64_3;
+    h ^= h >> 32;
+
+    return h;
+}
+
+static PyObject *
+key_hash(PyObject *module, PyObject *args) {
+    const char *data;
+    Py_ssize_t size;
+    unsigned long long seed = 0;
+
+    if (! PyArg_ParseTuple(args, "s#|K", &data, &size, &seed) ) {
+        return NULL;
+    }
+
+    return PyLong_FromUnsignedLongLong(xxh64((const uint8_t *) data, size, seed));
+}
+
+/* Jump consistent hash (Lamping & Veach, https://arxiv.org/abs/1406.2294):
+   the bucket of a 64 bits hash among *buckets*, growing the number of buckets
+   from n to n + 1 only moves 1 / (n + 1) of the hashes (to the new bucket) */
+static int32_t
+jump_bucket(uint64_t hash, int32_t buckets) {
+    int64_t b = -1, j = 0;
+
+    while ( j < buckets ) {
+        b = j;
+        hash = hash * 2862933555777941757ULL + 1;
+        j = (int64_t) ((b + 1) * ((double) (1LL << 31) / (double) ((hash >> 33) + 1)));
+    }
+
+    return (int32_t) b;
+}
+
+static PyObject *
+jump_hash(PyObject *module, PyObject *args) {
+    const char *data;
+    Py_ssize_t size;
+    int buckets;
+
+    if (! PyArg_ParseTuple(args, "s#i", &data, &size, &buckets) ) {
+        return NULL;
+    }
+
+    if ( buckets <= 0 ) {
+        PyErr_SetString(PyExc_ValueError, "buckets must be greater than 0");
+        return NULL;
+    }
+
+    return PyLong_FromLong(jump_bucket(xxh64((const uint8_t *) data, size, 0), buckets));
+}
+
 static PyMethodDef ModuleMethods[] = {
     {"_set_fake_now",  set_fake_now, METH_VARARGS,
      "Set the absolute time of fake internal clock "
      "to {value} milliseconds (for tests)"},
     {"_get_fake_now",  get_fake_now, METH_NOARGS,
      "Get the absolute time (in milliseconds of fake internal clock (for tests)"},
+    {"key_hash",  key_hash, METH_VARARGS,
+     "key_hash(key, seed=0): 64 bits XXH64 hash of a str (UTF-8) or bytes key"},
+    {"jump_hash",  jump_hash, METH_VARARGS,
+     "jump_hash(key, buckets): bucket of a str (UTF-8) or bytes key, "
+     "jump consistent hash of its XXH64 hash (seed 0)"},
     {NULL}        /* Sentinel */
 };
 
@@ -559,6 +1885,14 @@ PyInit__ratelimit(void)
 {
     PyObject* module;
 
+    if (PyType_Ready(&pyrated_HistogramType) < 0) {
+        return NULL;
+    }
+
+    if (PyType_Ready(&pyrated_RingPoolType) < 0) {
+        return NULL;
+    }
+
     if (PyType_Ready(&pyrated_RentryType) < 0) {
         return NULL;
     }
@@ -572,7 +1906,13 @@ PyInit__ratelimit(void)
         return NULL;
     }
 
+#ifdef Py_GIL_DISABLED
+    PyUnstable_Module_SetGIL(module, Py_MOD_GIL_NOT_USED);
+#endif
+
 
+    Py_INCREF(&pyrated_HistogramType);
+    PyModule_AddObject(module, "Histogram", (PyObject *)&pyrated_HistogramType);
     Py_INCREF(&pyrated_RentryType);
     Py_INCREF(&pyrated_RatelimitBaseType);
     PyModule_AddObject(module, "Rentry",(PyObject *)&pyrated_RentryType);
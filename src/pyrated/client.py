@@ -0,0 +1,209 @@
+import socket
+
+from .cluster import MOVED, Cluster, parse_address
+
+
+class ServerError(Exception):
+    """
+    Error reply of a server
+
+    """
+
+
+class Connection:
+    """
+    A blocking TCP connection to a node, replies are read line by line
+
+    """
+
+    def __init__(self, address, timeout):
+        self.address = address
+        self.sock = socket.create_connection(address, timeout)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.file = self.sock.makefile("rb")
+
+    def request(self, data: bytes, multiline=False) -> list[bytes]:
+        """
+        Send a command, returns the lines of its reply (without line ends)
+
+        Multiline replies (get, gets) end with an END line, not included
+
+        """
+        self.sock.sendall(data)
+
+        lines = []
+        while True:
+            line = self.file.readline()
+            if not line.endswith(b"\r\n"):
+                raise ConnectionError("connection to %s:%d closed" % self.address)
+
+            line = line[:-2]
+            if not multiline or line == b"END":
+                break
+
+            if line.startswith(b"VALUE "):
+                lines.append(line)
+                lines.append(self.file.readline()[:-2])
+                continue
+
+            # Error reply
+            return [line]
+
+        if multiline:
+            return lines
+
+        return [line]
+
+    def close(self):
+        self.file.close()
+        self.sock.close()
+
+
+class Client:
+    """
+    Client of a pyrated server or cluster (memcached protocol over TCP)
+
+    Keys are assigned to *nodes* with the same jump consistent hash as the
+    servers in cluster mode (see --cluster), give the nodes in the same
+    order. A key sent to the wrong node (the client and the servers do not
+    agree on the ring) is redirected by the server, and the client follows
+    the redirection
+
+    Up to *pool_size* idle connections are kept for each node, a client may
+    be shared between threads. A pooled connection closed in the meantime
+    (restarted node, idle timeout) is replaced by a new one, once
+
+    """
+
+    max_redirects = 1
+
+    def __init__(self, nodes, pool_size=8, timeout=1.0):
+        self.cluster = Cluster(nodes)
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self._pools = {}  # address: idle connections
+
+    def hit(self, key) -> bool:
+        """
+        Hit *key*, True if the hit is allowed
+
+        """
+        (line,) = self.command(key, b"incr %s\r\n" % self.encode(key))
+        return line == b"0"
+
+    def get(self, key) -> float | None:
+        """
+        Seconds before the next allowed hit of *key* (0.0 if allowed now),
+        None for an unknown key
+
+        """
+        lines = self.command(key, b"get %s\r\n" % self.encode(key), True)
+        if not lines:
+            return None
+
+        return float(lines[1])
+
+    def remaining(self, key) -> int | None:
+        """
+        Number of hits still allowed for *key*, None for an unknown key
+
+        """
+        lines = self.command(key, b"gets %s\r\n" % self.encode(key), True)
+        if not lines:
+            return None
+
+        return int(lines[0].split()[4])
+
+    def delete(self, key) -> bool:
+        """
+        Forget the hits of *key*, False for an unknown key
+
+        """
+        (line,) = self.command(key, b"delete %s\r\n" % self.encode(key))
+        return line == b"DELETED"
+
+    @staticmethod
+    def encode(key) -> bytes:
+        if isinstance(key, str):
+            key = key.encode()
+
+        if not key or len(key) > 250 or any(c <= 32 or c == 127 for c in key):
+            raise ValueError("invalid key %r" % key)
+
+        return key
+
+    def command(self, key, data, multiline=False) -> list[bytes]:
+        """
+        Send a command about *key* to the node owning it, following
+        redirections, returns the lines of the reply
+
+        """
+        address = self.cluster.address(key)
+
+        for _ in range(self.max_redirects + 1):
+            lines = self.request(address, data, multiline)
+
+            if lines and lines[0].startswith(MOVED.encode()):
+                address = parse_address(lines[0][len(MOVED) :].decode())
+                continue
+
+            if lines and lines[0].startswith((b"ERROR", b"SERVER_ERROR")):
+                raise ServerError(lines[0].decode())
+
+            return lines
+
+        raise ServerError("too many redirections for key %r" % key)
+
+    def request(self, address, data, multiline=False) -> list[bytes]:
+        """
+        Send a command to a node with a pooled connection, retried on a new
+        connection if the pooled one was closed by the server
+
+        """
+        connection, pooled = self.acquire(address)
+        try:
+            lines = connection.request(data, multiline)
+        except ConnectionError:
+            # Not for timeouts, the node may have handled the command
+            connection.close()
+            if not pooled:
+                raise
+
+            connection = Connection(address, self.timeout)
+            try:
+                lines = connection.request(data, multiline)
+            except BaseException:
+                connection.close()
+                raise
+        except BaseException:
+            connection.close()
+            raise
+
+        self.release(connection)
+        return lines
+
+    def acquire(self, address) -> tuple[Connection, bool]:
+        """
+        An idle connection to *address* (True) or a new one (False)
+
+        """
+        try:
+            return self._pools.setdefault(address, []).pop(), True
+        except IndexError:
+            return Connection(address, self.timeout), False
+
+    def release(self, connection):
+        pool = self._pools.setdefault(connection.address, [])
+        if len(pool) < self.pool_size:
+            pool.append(connection)
+        else:
+            connection.close()
+
+    def close(self):
+        """
+        Close all the idle connections
+
+        """
+        for pool in self._pools.values():
+            while pool:
+                pool.pop().close()
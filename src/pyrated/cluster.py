@@ -0,0 +1,97 @@
+from ._ratelimit import jump_hash
+
+# Reply to a command sent to the wrong node of a cluster, followed by the
+# address of the node owning the key
+MOVED = "SERVER_ERROR moved "
+
+
+def parse_address(value: str) -> tuple[str, int]:
+    """
+    Parse a host:port node address, [host]:port for IPv6 addresses
+
+    """
+    host, sep, port = value.rpartition(":")
+    if not sep or not host or not port.isdigit():
+        raise ValueError("invalid node address %r (host:port)" % value)
+
+    if host.startswith("[") and host.endswith("]"):
+        host = host[1:-1]
+
+    return host, int(port)
+
+
+def format_address(address: tuple[str, int]) -> str:
+    host, port = address
+    if ":" in host:
+        return "[%s]:%d" % (host, port)
+
+    return "%s:%d" % (host, port)
+
+
+class Cluster:
+    """
+    Ring of the nodes of a cluster, each key belongs to a single node
+
+    Keys are assigned with a jump consistent hash: appending a node to a
+    ring of n nodes only moves 1 / (n + 1) of the keys (to the new node),
+    the others keep their node and their recorded hits. Nodes must be
+    listed in the same order everywhere, and only added at the end
+
+    *index* is the position of the local node in the ring (servers only)
+
+    """
+
+    def __init__(self, nodes, index=None):
+        self.nodes = [
+            parse_address(node) if isinstance(node, str) else tuple(node)
+            for node in nodes
+        ]
+
+        if not self.nodes:
+            raise ValueError("a cluster needs at least one node")
+
+        if index is not None and not 0 <= index < len(self.nodes):
+            raise ValueError("node index out of range (%d)" % index)
+
+        self.index = index
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def node(self, key) -> int:
+        """
+        Index of the node owning *key*
+
+        """
+        return jump_hash(key, len(self.nodes))
+
+    def address(self, key) -> tuple[str, int]:
+        """
+        Address of the node owning *key*
+
+        """
+        return self.nodes[jump_hash(key, len(self.nodes))]
+
+    def moved_reply(self, keys) -> bytes | None:
+        """
+        The redirection reply if *keys* belong to another node than the
+        local one, None when they can all be handled here
+
+        Keys of a multi-key command owned by several nodes are refused with
+        a client error, a redirection would send them back and forth
+
+        """
+        if not keys:
+            return None
+
+        count = len(self.nodes)
+        nodes = {jump_hash(key, count) for key in keys}
+
+        if nodes == {self.index}:
+            return None
+
+        if len(nodes) > 1:
+            return b"CLIENT_ERROR keys belong to different nodes\r\n"
+
+        (node,) = nodes
+        return b"%s%s\r\n" % (MOVED.encode(), format_address(self.nodes[node]).encode())
@@ -0,0 +1,445 @@
+"""
+Loop-less server, built directly on top of selectors (epoll on Linux)
+
+No asyncio Transport/Protocol machinery: each readable event does a single
+recv_into a preallocated buffer, all the lines received are handled by the
+memcached protocol, and the replies are sent back with a single send call
+
+"""
+
+import functools
+import os
+import selectors
+import socket
+import stat
+import time
+
+EVENT_READ = selectors.EVENT_READ
+EVENT_WRITE = selectors.EVENT_WRITE
+
+
+def bind_sockets(hosts, port, backlog=100):
+    """
+    Create non-blocking listening TCP sockets for every address
+    the hosts resolve to (same behavior as asyncio's create_server)
+
+    """
+    sockets = []
+    seen = set()
+
+    for host in hosts:
+        infos = socket.getaddrinfo(
+            host, port, type=socket.SOCK_STREAM, flags=socket.AI_PASSIVE
+        )
+        for family, _, _, _, address in infos:
+            if (family, address) in seen:
+                continue
+            seen.add((family, address))
+
+            sock = socket.create_server(address, family=family, backlog=backlog)
+            sock.setblocking(False)
+            sockets.append(sock)
+
+    return sockets
+
+
+def bind_datagram_sockets(hosts, port, rcvbuf=4 * 1024 * 1024):
+    """
+    Create non-blocking UDP sockets for every address the hosts resolve to
+
+    The receive buffer is enlarged (up to the system limit) to absorb
+    bursts coming from many clients
+
+    """
+    sockets = []
+    seen = set()
+
+    for host in hosts:
+        infos = socket.getaddrinfo(
+            host, port, type=socket.SOCK_DGRAM, flags=socket.AI_PASSIVE
+        )
+        for family, _, _, _, address in infos:
+            if (family, address) in seen:
+                continue
+            seen.add((family, address))
+
+            sock = socket.socket(family, socket.SOCK_DGRAM)
+            try:
+                if family == socket.AF_INET6:
+                    sock.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_V6ONLY, 1)
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, rcvbuf)
+                sock.bind(address)
+            except OSError:
+                sock.close()
+                raise
+
+            sock.setblocking(False)
+            sockets.append(sock)
+
+    return sockets
+
+
+def remove_unix_socket(path):
+    """
+    Remove the file of a unix socket, if any (abstract sockets have none)
+
+    """
+    if path.startswith("\0"):
+        return
+
+    try:
+        if stat.S_ISSOCK(os.stat(path).st_mode):
+            os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def bind_unix_socket(path, backlog=100):
+    """
+    Create a non-blocking listening unix socket, path starting with
+    a null byte are in the linux abstract namespace
+
+    A stale socket file from a previous run is removed
+
+    """
+    remove_unix_socket(path)
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.bind(path)
+        sock.listen(backlog)
+    except OSError:
+        sock.close()
+        raise
+
+    sock.setblocking(False)
+    return sock
+
+
+class Connection:
+    """
+    A client connection, also acts as the (minimal) transport of the protocol:
+    replies are accumulated and sent once per loop iteration
+
+    Like asyncio transports, the protocol writing is paused when more than
+    the high water mark of replies is waiting to be sent
+
+    """
+
+    __slots__ = (
+        "server",
+        "sock",
+        "protocol",
+        "wbuffer",
+        "events",
+        "reading",
+        "closing",
+        "dirty",
+        "high_water",
+        "low_water",
+        "write_paused",
+    )
+
+    def __init__(self, server, sock, protocol):
+        self.server = server
+        self.sock = sock
+        self.protocol = protocol
+        self.wbuffer = bytearray()
+        self.events = 0
+        self.reading = True
+        self.closing = False
+        self.dirty = False
+        self.high_water = 64 * 1024
+        self.low_water = 16 * 1024
+        self.write_paused = False
+
+        protocol.connection_made(self)
+
+    # Transport interface, as used by the protocol
+
+    def write(self, data):
+        self.wbuffer += data
+        self.mark_dirty()
+
+        if not self.write_paused and len(self.wbuffer) > self.high_water:
+            self.write_paused = True
+            self.protocol.pause_writing()
+
+    def close(self):
+        self.closing = True
+        self.mark_dirty()
+
+    def is_closing(self):
+        return self.closing
+
+    def pause_reading(self):
+        self.reading = False
+        self.mark_dirty()
+
+    def resume_reading(self):
+        self.reading = True
+        self.mark_dirty()
+
+    def set_write_buffer_limits(self, high, low):
+        self.high_water = high
+        self.low_water = low
+
+    # Server side
+
+    def mark_dirty(self):
+        """
+        Flush pending writes and update polled events at the end of the
+        current loop iteration
+
+        """
+        if not self.dirty:
+            self.dirty = True
+            self.server.dirty.append(self)
+
+    def on_event(self, mask):
+        if mask & EVENT_READ and self.reading and not self.closing:
+            try:
+                self.read()
+            except Exception:
+                self.server.connection_error(self)
+                return
+
+        if mask & EVENT_WRITE:
+            self.mark_dirty()
+
+    def read(self):
+        try:
+            size = self.sock.recv_into(self.server.rbuffer)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            size = 0
+
+        if size == 0:
+            # EOF or connection reset, nothing more to send either
+            self.wbuffer.clear()
+            self.close()
+            return
+
+        self.protocol.data_received(self.server.rview[:size])
+
+    def flush(self):
+        self.dirty = False
+
+        if self.wbuffer:
+            try:
+                sent = self.sock.send(self.wbuffer)
+            except (BlockingIOError, InterruptedError):
+                sent = 0
+            except OSError:
+                self.wbuffer.clear()
+                self.closing = True
+                sent = 0
+
+            del self.wbuffer[:sent]
+
+        if self.closing:
+            if not self.wbuffer:
+                self.server.close_connection(self)
+                return
+        elif self.write_paused and len(self.wbuffer) <= self.low_water:
+            self.write_paused = False
+            self.protocol.resume_writing()
+
+        # Only poll for writability while there is something left to send
+        events = EVENT_READ if self.reading and not self.closing else 0
+        if self.wbuffer:
+            events |= EVENT_WRITE
+
+        if events != self.events:
+            if not events:
+                self.server.selector.unregister(self.sock)
+            elif not self.events:
+                self.server.selector.register(self.sock, events, self.on_event)
+            else:
+                self.server.selector.modify(self.sock, events, self.on_event)
+            self.events = events
+
+
+class SelectorServer:
+    """
+    Serve a protocol class (created by MemcachedServerProtocol.create_class)
+    on already bound listening sockets
+
+    *datagrams* are MemcachedDatagramProtocol instances (sharing the same
+    ratelimit), served along the stream sockets
+
+    The ratelimit cleanup is run every *cleanup_interval* seconds from the
+    same thread, between two selector polls, followed by a compaction
+    spread over the next iterations
+
+    """
+
+    def __init__(
+        self,
+        protocol_class,
+        sockets,
+        datagrams=(),
+        cleanup_interval=30.0,
+        recv_size=65536,
+    ):
+        self.protocol_class = protocol_class
+        self.sockets = sockets
+        self.datagrams = datagrams
+        self.cleanup_interval = cleanup_interval
+
+        self.rbuffer = bytearray(recv_size)
+        self.rview = memoryview(self.rbuffer)
+
+        self.selector = None
+        self.connections = set()
+        self.dirty = []  # Connections to flush at the end of the iteration
+        self.ready = []  # Callbacks to run on the next iteration
+        self._running = True  # A stop() before serve_forever() is not lost
+        self._wakeup_r, self._wakeup_w = socket.socketpair()
+        self._wakeup_r.setblocking(False)
+        self._wakeup_w.setblocking(False)
+
+    def stop(self):
+        """
+        Stop serving, may be called from a signal handler or another thread
+
+        """
+        self._running = False
+        try:
+            self._wakeup_w.send(b"\0")
+        except OSError:
+            pass
+
+    def call_soon(self, callback, connection=None):
+        """
+        Run *callback* on the next iteration, an exception closes
+        *connection* (if given) instead of stopping the server
+
+        """
+        self.ready.append((callback, connection))
+
+    def _wakeup(self, mask):
+        try:
+            self._wakeup_r.recv(4096)
+        except OSError:
+            pass
+
+    def _accept(self, sock, mask):
+        try:
+            conn, _ = sock.accept()
+        except (BlockingIOError, InterruptedError, ConnectionAbortedError):
+            return
+
+        conn.setblocking(False)
+        if conn.family != socket.AF_UNIX:
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+        protocol = self.protocol_class()
+        connection = Connection(self, conn, protocol)
+
+        # The protocol continuations are run by this server, not by asyncio
+        protocol.schedule = functools.partial(self.call_soon, connection=connection)
+
+        self.connections.add(connection)
+        connection.flush()
+
+    def connection_error(self, connection):
+        """
+        The protocol failed to handle data of a connection: log the error
+        and close that connection only (asyncio does the same)
+
+        """
+        import logging
+
+        logging.getLogger(__name__).exception("Error handling a connection, closing it")
+
+        # Replies already written are still sent
+        connection.close()
+
+    def close_connection(self, connection):
+        if connection not in self.connections:
+            return
+
+        self.connections.discard(connection)
+        if connection.events:
+            self.selector.unregister(connection.sock)
+            connection.events = 0
+        connection.sock.close()
+        connection.protocol.connection_lost(None)
+
+    def serve_forever(self):
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self._wakeup_r, EVENT_READ, self._wakeup)
+        for sock in self.sockets:
+            sock.setblocking(False)
+            self.selector.register(
+                sock, EVENT_READ, functools.partial(self._accept, sock)
+            )
+        for datagram in self.datagrams:
+            self.selector.register(
+                datagram.sock, EVENT_READ, lambda mask, d=datagram: d.read_ready()
+            )
+
+        rlist = self.protocol_class.rlist
+        next_cleanup = time.monotonic() + self.cleanup_interval
+        compacting = False
+
+        # Loop lag sampling, with the instrumentation enabled
+        stats = self.protocol_class.stats
+        next_sample = float("inf")
+        if stats is not None:
+            next_sample = time.monotonic() + stats.lag_interval
+
+        try:
+            while self._running:
+                if self.ready or compacting:
+                    timeout = 0
+                else:
+                    wakeup = min(next_cleanup, next_sample)
+                    timeout = max(0.0, wakeup - time.monotonic())
+
+                for key, mask in self.selector.select(timeout):
+                    key.data(mask)
+
+                ready, self.ready = self.ready, []
+                for callback, connection in ready:
+                    if connection is None:
+                        callback()
+                        continue
+
+                    try:
+                        callback()
+                    except Exception:
+                        self.connection_error(connection)
+
+                dirty, self.dirty = self.dirty, []
+                for connection in dirty:
+                    connection.flush()
+
+                if compacting:
+                    # One compaction chunk per iteration
+                    visited, _ = rlist.compact(rlist.compact_budget)
+                    compacting = visited >= rlist.compact_budget
+
+                if time.monotonic() >= next_cleanup:
+                    rlist.cleanup()
+                    next_cleanup = time.monotonic() + self.cleanup_interval
+                    compacting = rlist.compact_budget > 0
+
+                if time.monotonic() >= next_sample:
+                    stats.record_lag(next_sample)
+                    next_sample = time.monotonic() + stats.lag_interval
+        finally:
+            for connection in list(self.connections):
+                self.close_connection(connection)
+            for sock in self.sockets:
+                self.selector.unregister(sock)
+                sock.close()
+            for datagram in self.datagrams:
+                self.selector.unregister(datagram.sock)
+                datagram.sock.close()
+            self.selector.close()
+            self.selector = None
+            self._wakeup_r.close()
+            self._wakeup_w.close()
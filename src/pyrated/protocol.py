@@ -1,29 +1,185 @@
-import asyncio
-from typing import ClassVar
+import struct
+from time import perf_counter_ns
 
-from pyrated.ratelimit import Ratelimit
+from pyrated.cluster import Cluster
+from pyrated.ratelimit import Ratelimit, RatelimitDef, key_hash as hash_key
+from pyrated.stats import Stats
 
+# memcached UDP frame header:
+# request id, sequence number, total number of datagrams, reserved
+UDP_HEADER = struct.Struct(">HHHH")
+UDP_MAX_PAYLOAD = 1400 - UDP_HEADER.size
 
-class MemcachedServerProtocol(asyncio.Protocol):
+
+class BaseMemcachedProtocol:
     _class_counter = 0
-    rlist: ClassVar[Ratelimit]
+    rlist: Ratelimit  # Shared by all instances, see create_class
+
+    # Replace keys by their 64 bits hash (seeded with key_seed) before lookup,
+    # for a fixed memory footprint whatever the length of keys sent
+    key_hash = False
+    key_seed = 0
+
+    # Instrumentation (latency histograms), disabled by default
+    stats: Stats | None = None
+
+    # Cluster mode: commands on keys owned by other nodes are redirected
+    cluster: Cluster | None = None
 
     @classmethod
-    def create_class(cls, rlist: Ratelimit):
+    def create_class(cls, rlist: Ratelimit, **options):
         """
         Allow use of distinct subclasses each sharing their own state
 
+        *options* override class attributes (read_budget, write_high_water...)
+
         """
+        for name in options:
+            if not hasattr(cls, name):
+                raise TypeError("unknown protocol option %r" % name)
+
         cls._class_counter += 1
 
-        ret = type(cls.__name__ + str(cls._class_counter), (cls,), {})
+        ret = type(cls.__name__ + str(cls._class_counter), (cls,), options)
         ret.rlist = rlist
 
         return ret
 
+    def normalize(self, key):
+        """
+        The key actually stored in the ratelimit
+
+        """
+        if self.key_hash:
+            return hash_key(key, self.key_seed)
+
+        return key
+
+    def get_reply(self, keys, remaining=False) -> bytes:
+        """
+        Values are the number of seconds before the next allowed hit,
+        with *remaining* (gets command) the number of hits still allowed
+        is given as the "cas unique" of each value
+
+        """
+        if self.cluster is not None:
+            moved = self.cluster.moved_reply(keys)
+            if moved:
+                return moved
+
+        lookup = keys
+        if self.key_hash:
+            lookup = [hash_key(key, self.key_seed) for key in keys]
+
+        reply = []
+        for key, (exists, left, next_hit) in zip(keys, self.rlist.get_many(lookup)):
+            if not exists:
+                continue
+
+            value = "%d.%03d" % divmod(next_hit, 1000)
+            if remaining:
+                reply.append(
+                    "VALUE %s 0 %d %d\r\n%s\r\n" % (key, len(value), left, value)
+                )
+            else:
+                reply.append("VALUE %s 0 %d\r\n%s\r\n" % (key, len(value), value))
+
+        reply.append("END\r\n")
+        return "".join(reply).encode()
+
+    def stats_reply(self, args) -> bytes:
+        """
+        "stats detail" dumps the latency histograms, "stats reset" clears them
+
+        """
+        args = list(args)
+        if args not in (["detail"], ["detail", "dump"], ["reset"]):
+            return b"ERROR unknown command\r\n"
+
+        if self.stats is None:
+            return b"SERVER_ERROR instrumentation disabled\r\n"
+
+        if args == ["reset"]:
+            self.stats.reset()
+            return b"RESET\r\n"
+
+        return self.stats.detail()
+
+    def delete_reply(self, key) -> bytes:
+        if self.cluster is not None:
+            moved = self.cluster.moved_reply((key,))
+            if moved:
+                return moved
+
+        if self.rlist.remove(self.normalize(key)):
+            return b"DELETED\r\n"
+
+        return b"NOT_FOUND\r\n"
+
+
+class MemcachedServerProtocol(BaseMemcachedProtocol):
+    """
+    memcached TCP protocol, implements the asyncio.Protocol interface
+
+    It does not inherit asyncio.Protocol, so that the selector server
+    (and the library) can be used without importing asyncio at all
+
+    """
+
+    # Maximum number of lines handled for a connection in one loop iteration,
+    # the remaining ones are handled in the next iterations (reading paused)
+    read_budget = 1000
+
+    # Transport write buffer limits, reading is paused (and the received lines
+    # are kept) while the client does not read its replies
+    write_high_water = 64 * 1024
+    write_low_water = 16 * 1024
+
+    # Allow the admin commands (limit)
+    admin = False
+
     def connection_made(self, transport):
         self.transport = transport
         self.buffer = b""
+        self.pending = []  # Received lines, not handled yet
+        self.scheduled = False
+        self.reading = True
+        self.write_paused = False
+        self.closed = False
+        self.line_too_long = False  # Close once the pending lines are handled
+
+        transport.set_write_buffer_limits(self.write_high_water, self.write_low_water)
+
+    def connection_lost(self, exc):
+        self.closed = True
+        self.pending.clear()
+
+    def eof_received(self):
+        # Let the transport close itself
+        return None
+
+    def schedule(self, callback):
+        import asyncio
+
+        asyncio.get_running_loop().call_soon(callback)
+
+    def pause_writing(self):
+        self.write_paused = True
+        self.set_reading(False)
+
+    def resume_writing(self):
+        self.write_paused = False
+        self.process_pending()
+
+    def set_reading(self, reading):
+        if reading == self.reading or self.closed:
+            return
+
+        self.reading = reading
+        if reading:
+            self.transport.resume_reading()
+        else:
+            self.transport.pause_reading()
 
     def handle_line(self, line):
         command, *args = line.split(" ")
@@ -36,21 +192,48 @@ class MemcachedServerProtocol(asyncio.Protocol):
         if command == "get":
             return self.handle_get(*args)
 
+        if command == "gets":
+            return self.handle_gets(*args)
+
         if command == "delete":
             return self.handle_delete(*args)
 
+        if command == "stats":
+            return self.transport.write(self.stats_reply(args))
+
+        if command == "limit" and self.admin:
+            return self.handle_limit(*args)
+
         self.transport.write(b"ERROR unknown command\r\n")
 
+    def handle_line_timed(self, line):
+        """
+        handle_line, recording the parsing and command durations (stats)
+
+        """
+        start = perf_counter_ns()
+        line = line.rstrip().decode()
+        parsed = perf_counter_ns()
+        self.handle_line(line)
+
+        self.stats.record_command(line, parsed - start, perf_counter_ns() - parsed)
+
     def handle_get(self, *keys):
-        for key in filter(self.rlist.__contains__, keys):
-            value = str(self.rlist.next_hit(key) / 1000)
-            data = "VALUE %s 0 %d\r\n%s\r\n" % (key, len(value), value)
-            self.transport.write(data.encode())
+        self.transport.write(self.get_reply(keys))
 
-        self.transport.write(b"END\r\n")
+    def handle_gets(self, *keys):
+        self.transport.write(self.get_reply(keys, remaining=True))
 
     def handle_incr(self, key, noreply=None, *args):
-        ret = b"0" if self.rlist.hit(key) else b"1"
+        if self.cluster is not None:
+            moved = self.cluster.moved_reply((key,))
+            if moved:
+                # Misrouted hits are not recorded (nor replied with noreply)
+                if noreply != "noreply":
+                    self.transport.write(moved)
+                return
+
+        ret = b"0" if self.rlist.hit(self.normalize(key)) else b"1"
 
         if noreply == "noreply":
             return
@@ -58,29 +241,265 @@ class MemcachedServerProtocol(asyncio.Protocol):
         self.transport.write(ret + b"\r\n")
 
     def handle_delete(self, key, noreply=None):
-        removed = self.rlist.remove(key)
+        reply = self.delete_reply(key)
 
         if noreply == "noreply":
             return
 
-        if removed:
-            self.transport.write(b"DELETED\r\n")
-        else:
-            self.transport.write(b"NOT_FOUND\r\n")
+        self.transport.write(reply)
+
+    def handle_limit(self, definition=None):
+        """
+        "limit" replies with the current definition, "limit 20/1m" changes it
+        (the recorded hits are kept)
+
+        """
+        rlist = self.rlist
+
+        if definition is not None:
+            try:
+                limit = RatelimitDef(definition)
+                rlist.reconfigure(limit.count, limit.period)
+            except ValueError as exc:
+                return self.transport.write(b"CLIENT_ERROR %s\r\n" % str(exc).encode())
+
+        # In seconds, as the definitions without unit
+        self.transport.write(b"LIMIT %d/%d\r\n" % (rlist.count, rlist.period))
 
     def data_received(self, data):
         # print('got {} bytes: {}, last={!r}'.format(len(data),
         #                                            data[0:20], data[-1]))
 
-        lines = (self.buffer + data).split(b"\n")
+        if self.line_too_long:
+            return
 
-        for line in lines[:-1]:
-            # XXX try except?
-            self.handle_line(line.rstrip().decode())
+        lines = (self.buffer + data).split(b"\n")
 
         # '' in most cases, data left to read in others
-        self.buffer = lines[-1]
+        self.buffer = lines.pop()
 
-        # That's a very big line, cut connection
+        # That's a very big line, cut connection once the complete lines
+        # before it are answered
         if len(self.buffer) > 8096:
+            self.buffer = b""
+            self.line_too_long = True
+
+        self.pending.extend(lines)
+        self.process_pending()
+
+    def process_pending(self):
+        """
+        Handle the received lines, within the read budget and as long as
+        the transport accepts more replies
+
+        """
+        self.scheduled = False
+        if self.closed:
+            return
+
+        pending = self.pending
+        handled = 0
+
+        # Instrumentation, only one line out of stats.sample is timed
+        # (never reaching 0 when disabled)
+        stats = self.stats
+        countdown = -1 if stats is None else stats.countdown
+
+        try:
+            for line in pending:
+                if handled == self.read_budget or self.write_paused:
+                    break
+
+                handled += 1
+
+                try:
+                    countdown -= 1
+                    if countdown == 0:
+                        countdown = stats.sample
+                        self.handle_line_timed(line)
+                        continue
+
+                    self.handle_line(line.rstrip().decode())
+                except (TypeError, ValueError):
+                    # Missing arguments, or not UTF-8
+                    self.transport.write(b"ERROR\r\n")
+        except Exception:
+            # This may run from a scheduled callback, where nobody would
+            # close the connection: do not leave it hanging
+            self.transport.close()
+            self.connection_lost(None)
+            raise
+        finally:
+            if stats is not None:
+                stats.countdown = countdown
+
+        del pending[:handled]
+
+        if self.closed:
+            return
+
+        if self.line_too_long and not pending:
+            self.transport.write(b"CLIENT_ERROR line too long\r\n")
             self.transport.close()
+            self.connection_lost(None)
+            return
+
+        if pending and not self.write_paused and not self.scheduled:
+            # Let other connections be served before handling the rest
+            self.scheduled = True
+            self.schedule(self.process_pending)
+
+        self.set_reading(not pending and not self.write_paused)
+
+
+class MemcachedDatagramProtocol(BaseMemcachedProtocol):
+    """
+    memcached UDP protocol, served from a non-blocking datagram socket
+
+    Every datagram available when the socket becomes readable is read at
+    once (up to *max_batch*), and all the incr commands of those datagrams
+    are given to the ratelimit in a single hit_many call
+
+    Requests spanning multiple datagrams are not supported (as with memcached)
+
+    Since the source address of a datagram can be spoofed, only incr and
+    delete are served, and replies larger than their request are dropped:
+    the server can not be used to amplify a flood towards a third party
+
+    """
+
+    max_batch = 512
+
+    def __init__(self, sock):
+        self.sock = sock
+
+    def start(self, loop):
+        loop.add_reader(self.sock.fileno(), self.read_ready)
+
+    def close(self, loop):
+        loop.remove_reader(self.sock.fileno())
+        self.sock.close()
+
+    def read_ready(self):
+        batch = []
+        for _ in range(self.max_batch):
+            try:
+                batch.append(self.sock.recvfrom(65535))
+            except (BlockingIOError, InterruptedError):
+                break
+            except OSError:
+                # ICMP errors reported by some systems, nothing to do
+                break
+
+        if not batch:
+            return
+
+        if self.stats is None:
+            self.handle_batch(batch)
+        else:
+            start = perf_counter_ns()
+            self.handle_batch(batch)
+            self.stats.batch.record(perf_counter_ns() - start)
+
+    def handle_batch(self, batch):
+        requests = []  # (address, request id, request size, replies)
+        keys = []  # incr keys, hit all at once
+        slots = []  # where to put each incr result (None for noreply)
+
+        for data, address in batch:
+            if len(data) <= UDP_HEADER.size:
+                continue
+
+            request_id, _, total, _ = UDP_HEADER.unpack_from(data)
+            if total != 1:
+                continue
+
+            replies = []
+            requests.append((address, request_id, len(data), replies))
+
+            for line in data[UDP_HEADER.size :].split(b"\n"):
+                line = line.rstrip()
+                if not line:
+                    continue
+
+                try:
+                    command, *args = line.decode().split(" ")
+                except UnicodeDecodeError:
+                    replies.append(b"ERROR\r\n")
+                    continue
+
+                if command == "incr":
+                    if not args:
+                        replies.append(b"ERROR\r\n")
+                        continue
+
+                    if self.cluster is not None:
+                        moved = self.cluster.moved_reply(args[:1])
+                        if moved:
+                            if args[1:2] != ["noreply"]:
+                                replies.append(moved)
+                            continue
+
+                    keys.append(self.normalize(args[0]))
+                    if args[1:2] == ["noreply"]:
+                        slots.append(None)
+                    else:
+                        slots.append((replies, len(replies)))
+                        replies.append(None)
+                    continue
+
+                # Other commands need to see the effect of previous hits
+                self.hit_batch(keys, slots)
+                replies.append(self.handle_command(command, *args))
+
+        self.hit_batch(keys, slots)
+
+        for address, request_id, size, replies in requests:
+            data = b"".join(filter(None, replies))
+            # No amplification (see above)
+            if data and len(data) + UDP_HEADER.size <= size:
+                self.send_reply(address, request_id, data)
+
+    def hit_batch(self, keys, slots):
+        if not keys:
+            return
+
+        for slot, allowed in zip(slots, self.rlist.hit_many(keys)):
+            if slot is not None:
+                replies, index = slot
+                replies[index] = b"0\r\n" if allowed else b"1\r\n"
+
+        keys.clear()
+        slots.clear()
+
+    def handle_command(self, command, *args):
+        if command == "delete":
+            try:
+                return self.handle_delete(*args)
+            except TypeError:
+                return b"ERROR\r\n"
+
+        # get, gets and stats replies would be larger than their request,
+        # a short error is returned for those (and any unknown command)
+        return b"ERROR\r\n"
+
+    def handle_delete(self, key, noreply=None):
+        reply = self.delete_reply(key)
+
+        if noreply == "noreply":
+            return None
+
+        return reply
+
+    def send_reply(self, address, request_id, data):
+        total = -(-len(data) // UDP_MAX_PAYLOAD)
+
+        for seq in range(total):
+            chunk = data[seq * UDP_MAX_PAYLOAD : (seq + 1) * UDP_MAX_PAYLOAD]
+            try:
+                self.sock.sendto(
+                    UDP_HEADER.pack(request_id, seq, total, 0) + chunk, address
+                )
+            except OSError:
+                # Socket buffer full or unreachable client, drop the reply
+                return
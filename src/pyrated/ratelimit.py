@@ -1,14 +1,20 @@
-import asyncio
 import math
 import weakref
 
-from ._ratelimit import RatelimitBase
+from ._ratelimit import RatelimitBase, key_hash  # noqa: F401
+
+# asyncio and threading are only imported when a cleanup is installed,
+# for a fast startup of short-lived processes
 
 
 class Ratelimit(RatelimitBase):
     """Not actually a list"""
 
-    def __init__(self, count, period, block_size=0.20):
+    # Number of entries compacted per loop iteration after each cleanup
+    # (0 to disable compaction)
+    compact_budget = 1000
+
+    def __init__(self, count, period, block_size=0.20, growth=2.0):
         """
         :param count: max number of hits for an entry of the list
         :param period: in seconds, the period in which each entry is limited
@@ -16,27 +22,51 @@ class Ratelimit(RatelimitBase):
             entry, defaults to a fifth of the maximum memory used
             Meaning at "worst" 5 memory allocations, or at "worst" a fifth
             of the memory wasted, depending on your point of view
+        :param growth: the memory of an entry grows geometrically by that
+            factor (and by at least block_size), 1.0 for a linear growth
 
         """
         self._entries = {}
 
-        if count <= 0:
-            raise ValueError("count must be greater than 0 (%d)" % count)
-
-        if period <= 0:
-            raise ValueError("period must be greater than 0 (%d)" % period)
-
-        if period > 86400 * 45:
-            raise ValueError("maximum period is 45 days (%d)" % period)
+        self.check_limits(count, period)
 
         if isinstance(block_size, float) and block_size <= 1.0:
             self.block_size = math.ceil(count * block_size)
         else:
             self.block_size = block_size
 
+        self.growth = growth
         self._count = count
         self._period = int(period * 1000)
         self._cleanup_task = None
+        self._cleanup_thread = None
+
+    @staticmethod
+    def check_limits(count, period):
+        if count <= 0:
+            raise ValueError("count must be greater than 0 (%d)" % count)
+
+        if count > 2**31 - 1:
+            raise ValueError("maximum count is 2**31 - 1 (%d)" % count)
+
+        if period <= 0:
+            raise ValueError("period must be greater than 0 (%d)" % period)
+
+        # Periods are stored in milliseconds on 31 bits (24.8 days)
+        if period > 86400 * 24:
+            raise ValueError("maximum period is 24 days (%d)" % period)
+
+    def reconfigure(self, count, period):
+        """
+        Change the count and period of a live list, keeping the recorded hits
+
+        There is no pass over all the entries, each one is resized on its
+        next use: hits older than the new period are forgotten, and only the
+        *count* most recent ones are kept
+
+        """
+        self.check_limits(count, period)
+        self._reconfigure(count, int(period * 1000))
 
     @property
     def count(self):
@@ -59,8 +89,8 @@ class Ratelimit(RatelimitBase):
         """
         Size of memory pre-allocations
 
-        For example a block size of 10 for a list of 25 will
-        allocate 10 slots on the first hit, 10 new more on the 11th hit,
+        For example a block size of 10 for a list of 25 (and a growth of 1.0)
+        will allocate 10 slots on the first hit, 10 new more on the 11th hit,
         and finally 5 slots on the 21th hit
 
         """
@@ -77,6 +107,30 @@ class Ratelimit(RatelimitBase):
 
         self._block_size = int(value)
 
+    @property
+    def growth(self):
+        """
+        Growth factor of memory allocations
+
+        For example a block size of 10 and a growth of 2.0 for a list of 100
+        will allocate 10 slots on the first hit, then 20, 40, 80 and finally
+        100 slots (the memory of an entry is reallocated each time)
+
+        Memory released by expired entries is recycled by new ones
+
+        """
+        return self._growth
+
+    @growth.setter
+    def growth(self, value):
+        if not isinstance(value, (int, float)):
+            raise TypeError("growth must be a number")
+
+        if value < 1.0:
+            raise ValueError("growth must be greater or equal to 1.0")
+
+        self._growth = float(value)
+
     def __iter__(self):
         return iter(self._entries)
 
@@ -94,6 +148,7 @@ class Ratelimit(RatelimitBase):
             "_count": self._count,
             "_period": self._period,
             "_block_size": self._block_size,
+            "_growth": self._growth,
             "_entries": self._entries,
         }
 
@@ -103,8 +158,10 @@ class Ratelimit(RatelimitBase):
         self._count = state["_count"]
         self._period = state["_period"]
         self._block_size = state["_block_size"]
+        self._growth = state.get("_growth", 1.0)
         self._entries = state["_entries"]
         self._cleanup_task = None
+        self._cleanup_thread = None
 
     def install_cleanup(self, loop, interval=30.0):
         """
@@ -122,21 +179,57 @@ class Ratelimit(RatelimitBase):
 
         return self._cleanup_task
 
+    def install_cleanup_thread(self, interval=30.0):
+        """
+        Install a cleanup thread, running every interval seconds
+
+        To be used when the list is hit from a pool of threads (WSGI server)
+        instead of an asyncio loop, hit() may be called concurrently from
+        any number of threads
+
+        """
+        if interval < 0:
+            raise ValueError("Interval must be positive")
+
+        import threading
+
+        self.remove_cleanup()
+
+        stop = threading.Event()
+        thread = threading.Thread(
+            target=self.cleanup_thread_run,
+            args=(weakref.ref(self), stop, interval),
+            name="pyrated-cleanup",
+            daemon=True,
+        )
+        thread.stop = stop
+        thread.start()
+
+        self._cleanup_thread = thread
+
+        return thread
+
     def remove_cleanup(self):
         """
-        Remove/cancel the current cleanup task
+        Remove/cancel the current cleanup task or thread
 
         """
         if self._cleanup_task:
             self._cleanup_task.cancel()
             self._cleanup_task = None
 
+        if self._cleanup_thread:
+            self._cleanup_thread.stop.set()
+            self._cleanup_thread = None
+
     async def cleanup_run(self, interval):
         """
         Running task of the install_cleanup method, do a cleanup of the list
         every *interval* seconds
 
         """
+        import asyncio
+
         # Reference workaround: when a Ratelimit object has been deleted,
         # this coroutine would still hold a reference to it.
         self = weakref.proxy(self)
@@ -145,5 +238,63 @@ class Ratelimit(RatelimitBase):
             try:
                 await asyncio.sleep(interval)
                 self.cleanup()
+
+                # Compaction is spread over loop iterations
+                while self.compact_budget > 0:
+                    visited, _ = self.compact(self.compact_budget)
+                    if visited < self.compact_budget:
+                        break
+                    await asyncio.sleep(0)
             except (ReferenceError, asyncio.CancelledError):
                 break
+
+    @staticmethod
+    def cleanup_thread_run(ref, stop, interval):
+        """
+        Running function of the install_cleanup_thread method, do a cleanup
+        of the list every *interval* seconds until *stop* is set
+
+        """
+        # Only a weak reference is kept, same as cleanup_run
+        while not stop.wait(interval):
+            self = ref()
+            if self is None:
+                break
+
+            self.cleanup()
+            while self.compact_budget > 0:
+                visited, _ = self.compact(self.compact_budget)
+                if visited < self.compact_budget:
+                    break
+            del self
+
+
+class RatelimitDef:
+    """
+    Ratelimit defintition parsing
+        - 1/8 -> max 1 hit in 8 seconds
+        - 5/5 -> max 5 hits in 5 seconds
+        - 5/1m -> max 5 hits in one minute
+
+    """
+
+    def __init__(self, value):
+        import re
+
+        reg = r"(\d+)/(\d+)([mhd])?"
+        match = re.fullmatch(reg, value)
+        if not match:
+            raise ValueError("invalid definition %r (hits/period)" % value)
+
+        self.count = int(match.group(1))
+        self.period = int(match.group(2))
+
+        if match.group(3) == "m":
+            self.period *= 60
+        elif match.group(3) == "h":
+            self.period *= 3600
+        elif match.group(3) == "d":
+            self.period *= 86400
+
+    def __repr__(self):
+        return "%r/%r" % (self.count, self.period)
@@ -1,44 +1,37 @@
-import argparse
-import asyncio
-import re
+import os
 import signal
 import sys
-from typing import Coroutine
-
-from .protocol import MemcachedServerProtocol
-from .ratelimit import Ratelimit
-
-
-class RatelimitDef:
+from collections.abc import Callable, Coroutine
+
+from .cluster import Cluster, parse_address
+from .fastserver import (
+    SelectorServer,
+    bind_datagram_sockets,
+    bind_sockets,
+    bind_unix_socket,
+    remove_unix_socket,
+)
+from .protocol import MemcachedDatagramProtocol, MemcachedServerProtocol
+from .ratelimit import Ratelimit, RatelimitDef
+from .stats import Stats
+
+
+def get_loop_factory(name: str) -> Callable:
     """
-    Ratelimit defintition parsing
-        - 1/8 -> max 1 hit in 8 seconds
-        - 5/5 -> max 5 hits in 5 seconds
-        - 5/1m -> max 5 hits in one minute
+    Return the event loop constructor matching the --loop option
 
     """
+    import asyncio
 
-    def __init__(self, value):
-        reg = r"(\d+)/(\d+)([mhd])?"
-        match = re.match(reg, value)
-        if not match:
-            raise ValueError
+    if name == "uvloop":
+        import uvloop
 
-        self.count = int(match.group(1))
-        self.period = int(match.group(2))
+        return uvloop.new_event_loop
 
-        if match.group(3) == "m":
-            self.period *= 60
-        elif match.group(3) == "h":
-            self.period *= 3600
-        elif match.group(3) == "d":
-            self.period *= 86400
+    return asyncio.new_event_loop
 
-    def __repr__(self):
-        return "%r/%r" % (self.count, self.period)
 
-
-def run_in_loop(coro: Coroutine) -> asyncio.Task:  # pragma: no cover
+def run_in_loop(coro: Coroutine, loop_factory=None):  # pragma: no cover
     """
     Shorthand method to run a coroutine from "non-async" code
 
@@ -47,8 +40,9 @@ def run_in_loop(coro: Coroutine) -> asyncio.Task:  # pragma: no cover
     Returns the task that was created from the coroutine
 
     """
+    import asyncio
 
-    loop = asyncio.new_event_loop()
+    loop = (loop_factory or asyncio.new_event_loop)()
     task = asyncio.ensure_future(coro, loop=loop)
     loop.add_signal_handler(signal.SIGTERM, task.cancel)
     loop.add_signal_handler(signal.SIGINT, task.cancel)
@@ -57,7 +51,12 @@ def run_in_loop(coro: Coroutine) -> asyncio.Task:  # pragma: no cover
     return task
 
 
+LOOPS = ("asyncio", "uvloop", "selector")
+
+
 def parse_args(args):
+    import argparse
+
     parser = argparse.ArgumentParser(description="python ratelimit daemon")
     parser.add_argument(
         "definition",
@@ -70,16 +69,129 @@ def parse_args(args):
     parser.add_argument(
         "-p", "--port", type=int, default=11211, help="TCP port to listen to"
     )
+    parser.add_argument(
+        "-U",
+        "--udp-port",
+        type=int,
+        help="UDP port to listen to (on the same sources as TCP), disabled by default",
+    )
+    parser.add_argument(
+        "-u",
+        "--unix",
+        action="append",
+        metavar="PATH",
+        help="Unix socket path to listen to, @name for the abstract namespace",
+    )
+    parser.add_argument(
+        "--read-budget",
+        type=int,
+        default=MemcachedServerProtocol.read_budget,
+        metavar="LINES",
+        help="Maximum number of commands handled per connection per loop iteration",
+    )
+    parser.add_argument(
+        "--write-high-water",
+        type=int,
+        default=MemcachedServerProtocol.write_high_water,
+        metavar="BYTES",
+        help="Stop reading from a client once that many bytes of replies are "
+        "waiting to be sent to it",
+    )
+    parser.add_argument(
+        "--write-low-water",
+        type=int,
+        default=MemcachedServerProtocol.write_low_water,
+        metavar="BYTES",
+        help="Resume reading from a client once its replies waiting to be sent "
+        "are below that many bytes",
+    )
+    parser.add_argument(
+        "--key-hash",
+        action="store_true",
+        help="Store a 64 bits hash of the keys instead of the keys themselves "
+        "(fixed memory usage for long keys)",
+    )
+    parser.add_argument(
+        "--admin",
+        action="store_true",
+        help="Allow the 'limit' command, to change the ratelimit definition "
+        "without a restart (TCP and unix sockets only)",
+    )
+    parser.add_argument(
+        "--cluster",
+        action="append",
+        type=parse_address,
+        metavar="HOST:PORT",
+        help="A node of the cluster (this one included), once per node in the "
+        "same order on every node and client, new nodes are added at the end",
+    )
+    parser.add_argument(
+        "--node",
+        type=int,
+        metavar="INDEX",
+        help="Position of this node in the --cluster list (starting at 0)",
+    )
+    parser.add_argument(
+        "--stats",
+        action="store_true",
+        help="Record latency histograms, dumped by the 'stats detail' command "
+        "or on SIGUSR1",
+    )
+    parser.add_argument(
+        "--loop",
+        choices=LOOPS,
+        default="asyncio",
+        help="Event loop implementation, 'selector' is a loop-less fast server",
+    )
 
     args = parser.parse_args(args)
 
     # https://bugs.python.org/issue16399 -_-
+    if args.unix is None:
+        args.unix = []
+
+    # Only listen to TCP when explicitly asked if there are unix sockets
     if args.source is None:
-        args.source = ["localhost"]
+        args.source = [] if args.unix else ["localhost"]
+
+    if args.read_budget <= 0:
+        parser.error("the read budget must be greater than 0")
+
+    if not 0 <= args.write_low_water <= args.write_high_water:
+        parser.error("write low water must be between 0 and write high water")
+
+    # Random seed, so that colliding keys can not be crafted in advance
+    args.key_seed = int.from_bytes(os.urandom(8)) if args.key_hash else 0
+
+    if args.cluster is None:
+        if args.node is not None:
+            parser.error("--node requires --cluster")
+    elif args.node is None or not 0 <= args.node < len(args.cluster):
+        parser.error("--node must be the index of this node in the --cluster list")
+
+    if args.udp_port is not None and not args.source:
+        parser.error("UDP requires at least one source (-s)")
+
+    if args.loop == "uvloop":
+        import importlib.util
+
+        if importlib.util.find_spec("uvloop") is None:
+            parser.error("uvloop is not installed")
 
     return args
 
 
+def unix_address(path: str) -> str:
+    """
+    Convert the @name notation to a linux abstract socket address
+
+    """
+    if path.startswith("@"):
+        return "\0" + path[1:]
+
+    return path
+
+
 async def close_on_cancel(server):
     """
     Workaround breaking change in python 3.12+
@@ -88,6 +200,8 @@ async def close_on_cancel(server):
     We don't want that so tell server to close clients
 
     """
+    import asyncio
+
     try:
         while True:
             await asyncio.sleep(1000)
@@ -98,29 +212,148 @@ async def close_on_cancel(server):
             server.close_clients()
 
 
+def create_stats(args, rlist):
+    """
+    Instrumentation, if enabled: dumped on SIGUSR1 (on stderr)
+
+    """
+    if not args.stats:
+        return None
+
+    stats = Stats(rlist)
+    signal.signal(signal.SIGUSR1, lambda *_: stats.dump())
+
+    return stats
+
+
+def create_cluster(args):
+    """
+    The ring of nodes, in cluster mode
+
+    """
+    if args.cluster is None:
+        return None
+
+    return Cluster(args.cluster, args.node)
+
+
+def create_datagrams(args, rlist, stats=None):
+    """
+    Create the UDP protocol instances, if enabled
+
+    """
+    if args.udp_port is None:
+        return []
+
+    datagram_class = MemcachedDatagramProtocol.create_class(
+        rlist,
+        key_hash=args.key_hash,
+        key_seed=args.key_seed,
+        stats=stats,
+        cluster=create_cluster(args),
+    )
+    sockets = bind_datagram_sockets(args.source, args.udp_port)
+
+    interfaces = (str(sock.getsockname()[0]) for sock in sockets)
+    print("Serving on %s - UDP port %d" % (", ".join(interfaces), args.udp_port))
+
+    return [datagram_class(sock) for sock in sockets]
+
+
+def create_protocol_class(args, rlist, stats=None):
+    return MemcachedServerProtocol.create_class(
+        rlist,
+        read_budget=args.read_budget,
+        write_high_water=args.write_high_water,
+        write_low_water=args.write_low_water,
+        key_hash=args.key_hash,
+        key_seed=args.key_seed,
+        admin=args.admin,
+        stats=stats,
+        cluster=create_cluster(args),
+    )
+
+
 async def amain(args):
+    import asyncio
+
     rlist = Ratelimit(args.definition.count, args.definition.period)
-    protocol_class = MemcachedServerProtocol.create_class(rlist)
+    stats = create_stats(args, rlist)
+    protocol_class = create_protocol_class(args, rlist, stats)
 
     loop = asyncio.get_running_loop()
+    servers = []
 
-    server = await loop.create_server(protocol_class, args.source, args.port)
-    interfaces = (str(sock.getsockname()[0]) for sock in server.sockets)
-    print("Serving on %s - port %d" % (", ".join(interfaces), args.port))
+    if args.source:
+        server = await loop.create_server(protocol_class, args.source, args.port)
+        interfaces = (str(sock.getsockname()[0]) for sock in server.sockets)
+        print("Serving on %s - port %d" % (", ".join(interfaces), args.port))
+        servers.append(server)
+
+    for path in args.unix:
+        server = await loop.create_unix_server(protocol_class, unix_address(path))
+        print("Serving on unix socket %s" % path)
+        servers.append(server)
+
+    datagrams = create_datagrams(args, rlist, stats)
+    for datagram in datagrams:
+        datagram.start(loop)
 
     protocol_class.rlist.install_cleanup(loop)
-    canary = close_on_cancel(server)
+    if stats:
+        stats.install(loop)
+    canaries = [close_on_cancel(server) for server in servers]
     try:
-        await asyncio.gather(server.serve_forever(), canary)
+        await asyncio.gather(*(server.serve_forever() for server in servers), *canaries)
     except asyncio.CancelledError:
         pass
     finally:
         protocol_class.rlist.remove_cleanup()
+        if stats:
+            stats.remove()
+        for datagram in datagrams:
+            datagram.close(loop)
+        for path in args.unix:
+            remove_unix_socket(unix_address(path))
+
+
+def run_selector(args):  # pragma: no cover
+    """
+    Serve using the loop-less SelectorServer instead of asyncio
+
+    """
+    rlist = Ratelimit(args.definition.count, args.definition.period)
+    stats = create_stats(args, rlist)
+    protocol_class = create_protocol_class(args, rlist, stats)
+
+    sockets = bind_sockets(args.source, args.port)
+    if sockets:
+        interfaces = (str(sock.getsockname()[0]) for sock in sockets)
+        print("Serving on %s - port %d" % (", ".join(interfaces), args.port))
+
+    for path in args.unix:
+        sockets.append(bind_unix_socket(unix_address(path)))
+        print("Serving on unix socket %s" % path)
+
+    datagrams = create_datagrams(args, rlist, stats)
+    server = SelectorServer(protocol_class, sockets, datagrams)
+
+    signal.signal(signal.SIGTERM, lambda *_: server.stop())
+    signal.signal(signal.SIGINT, lambda *_: server.stop())
+    try:
+        server.serve_forever()
+    finally:
+        for path in args.unix:
+            remove_unix_socket(unix_address(path))
 
 
 def main():
     args = parse_args(sys.argv[1:])
-    run_in_loop(amain(args))
+
+    if args.loop == "selector":
+        run_selector(args)
+    else:
+        run_in_loop(amain(args), get_loop_factory(args.loop))
 
 
 if __name__ == "__main__":
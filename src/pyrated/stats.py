@@ -0,0 +1,143 @@
+import sys
+import time
+
+from ._ratelimit import Histogram
+
+COMMANDS = ("incr", "get", "gets", "delete", "stats", "limit")
+
+
+class Stats:
+    """
+    Opt-in instrumentation of the server, latency histograms of:
+        - cmd_<name>: each command, from its decoded line to its reply
+        - stage_parse: the decoding of each command line
+        - stage_ratelimit: each call to the ratelimit table (C code)
+        - udp_batch: each batch of datagrams
+        - cleanup_pause: each cleanup or compaction chunk (the server is
+          blocked during those)
+        - loop_lag: how late the server loop wakes up, sampled every
+          *lag_interval* seconds
+
+    To keep the overhead low, only one command line out of *sample* is
+    timed (cmd_* and stage_parse), and one ratelimit call out of *sample*
+    (stage_ratelimit), the other ones are recorded in full
+
+    Durations are recorded in nanoseconds, reported in microseconds
+
+    """
+
+    percentiles = (50.0, 90.0, 99.0, 99.9)
+
+    def __init__(self, rlist, lag_interval=0.1, sample=64):
+        self.histograms = {}
+        self.commands = {
+            name: self.histogram("cmd_" + name) for name in COMMANDS + ("unknown",)
+        }
+        self.parse = self.histogram("stage_parse")
+        self.ratelimit = self.histogram("stage_ratelimit", rlist._hit_histogram)
+        self.batch = self.histogram("udp_batch")
+        self.cleanup = self.histogram("cleanup_pause", rlist._cleanup_histogram)
+        self.lag = self.histogram("loop_lag")
+
+        self.lag_interval = lag_interval
+        self._lag_task = None
+
+        self.sample = sample
+        self.countdown = 1  # Lines left before the next timed one
+
+        rlist._sample = sample
+        rlist._instrumented = True
+
+    def histogram(self, name, histogram=None):
+        if histogram is None:
+            histogram = Histogram()
+
+        self.histograms[name] = histogram
+        return histogram
+
+    def record_command(self, line, parse, duration):
+        """
+        Record the durations of the parsing and handling of a command line
+
+        """
+        self.parse.record(parse)
+
+        name = line.partition(" ")[0]
+        histogram = self.commands.get(name) or self.commands["unknown"]
+        histogram.record(duration)
+
+    def record_lag(self, expected):
+        """
+        Record the lag of the loop, that was expected to wake up at
+        *expected* (time.monotonic)
+
+        """
+        self.lag.record(max(0, int((time.monotonic() - expected) * 1e9)))
+
+    def install(self, loop):
+        """
+        Install the loop lag sampling task in an asyncio loop
+
+        """
+        self.remove()
+        self._lag_task = loop.create_task(self.lag_run())
+
+        return self._lag_task
+
+    def remove(self):
+        if self._lag_task:
+            self._lag_task.cancel()
+            self._lag_task = None
+
+    async def lag_run(self):
+        import asyncio
+
+        while True:
+            expected = time.monotonic() + self.lag_interval
+            await asyncio.sleep(self.lag_interval)
+            self.record_lag(expected)
+
+    def items(self):
+        """
+        (name, value) of each statistic, histograms without any recorded
+        value are skipped
+
+        """
+        for name, histogram in sorted(self.histograms.items()):
+            if not histogram.count:
+                continue
+
+            yield "%s:count" % name, "%d" % histogram.count
+            yield "%s:mean_us" % name, "%.3f" % (
+                histogram.total / histogram.count / 1000
+            )
+            yield "%s:min_us" % name, "%.3f" % (histogram.min / 1000)
+            for percentile in self.percentiles:
+                yield "%s:p%g_us" % (name, percentile), "%.3f" % (
+                    histogram.value_at(percentile) / 1000
+                )
+            yield "%s:max_us" % name, "%.3f" % (histogram.max / 1000)
+
+    def detail(self) -> bytes:
+        """
+        Reply to the "stats detail" command
+
+        """
+        reply = ["STAT %s %s\r\n" % item for item in self.items()]
+        reply.append("END\r\n")
+
+        return "".join(reply).encode()
+
+    def dump(self, file=None):
+        """
+        Print all the statistics (on SIGUSR1)
+
+        """
+        file = file or sys.stderr
+        for name, value in self.items():
+            print("%s %s" % (name, value), file=file)
+        file.flush()
+
+    def reset(self):
+        for histogram in self.histograms.values():
+            histogram.reset()
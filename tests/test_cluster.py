@@ -0,0 +1,186 @@
+import socket
+import subprocess
+import sys
+import time
+
+import pytest
+
+from pyrated._ratelimit import jump_hash
+from pyrated.client import Client, ServerError
+from pyrated.cluster import Cluster, format_address, parse_address
+
+KEYS = ["key-%d" % i for i in range(20000)]
+
+
+def test_jump_hash():
+    assert jump_hash("foo", 1) == 0
+    assert jump_hash("foo", 3) == jump_hash(b"foo", 3)
+
+    with pytest.raises(ValueError):
+        jump_hash("foo", 0)
+
+    counts = [0] * 4
+    for key in KEYS:
+        counts[jump_hash(key, 4)] += 1
+
+    assert min(counts) > len(KEYS) / 4 * 0.9
+
+
+@pytest.mark.parametrize("nodes", [1, 2, 5, 10])
+def test_jump_hash_add_node(nodes):
+    # Adding a node only moves about 1/N of the keys, all to the new node
+    moved = 0
+    for key in KEYS:
+        before, after = jump_hash(key, nodes), jump_hash(key, nodes + 1)
+        if before != after:
+            assert after == nodes
+            moved += 1
+
+    assert moved == pytest.approx(len(KEYS) / (nodes + 1), rel=0.1)
+
+
+def test_address():
+    assert parse_address("localhost:11211") == ("localhost", 11211)
+    assert parse_address("[::1]:11211") == ("::1", 11211)
+
+    assert format_address(("localhost", 11211)) == "localhost:11211"
+    assert format_address(("::1", 11211)) == "[::1]:11211"
+
+    for value in ("localhost", ":11211", "localhost:foo"):
+        with pytest.raises(ValueError):
+            parse_address(value)
+
+
+def test_cluster():
+    cluster = Cluster(["127.0.0.1:11211", ("127.0.0.1", 11212)], 1)
+
+    assert len(cluster) == 2
+    assert cluster.node("foo") == 0
+    assert cluster.address("bar") == ("127.0.0.1", 11212)
+
+    assert cluster.moved_reply(["bar", "qux"]) is None
+    assert cluster.moved_reply([]) is None
+    assert cluster.moved_reply(["foo", "baz"]) == (
+        b"SERVER_ERROR moved 127.0.0.1:11211\r\n"
+    )
+    assert cluster.moved_reply(["bar", "foo"]) == (
+        b"CLIENT_ERROR keys belong to different nodes\r\n"
+    )
+
+    with pytest.raises(ValueError):
+        Cluster([])
+
+    with pytest.raises(ValueError):
+        Cluster(["127.0.0.1:11211"], 1)
+
+
+def unused_ports(count):
+    sockets = [socket.socket() for _ in range(count)]
+    for sock in sockets:
+        sock.bind(("127.0.0.1", 0))
+
+    ports = [sock.getsockname()[1] for sock in sockets]
+    for sock in sockets:
+        sock.close()
+
+    return ports
+
+
+@pytest.fixture
+def nodes():
+    """
+    A cluster of 3 local pyrated processes
+
+    """
+    ports = unused_ports(3)
+    ring = ["--cluster=127.0.0.1:%d" % port for port in ports]
+
+    processes = [
+        subprocess.Popen(
+            [sys.executable, "-m", "pyrated.server", "3/1m", "-s", "127.0.0.1"]
+            + ["-p", str(port), "--node", str(index)]
+            + ring,
+            stdout=subprocess.DEVNULL,
+        )
+        for index, port in enumerate(ports)
+    ]
+
+    try:
+        deadline = time.monotonic() + 5
+        for port in ports:
+            while True:
+                try:
+                    socket.create_connection(("127.0.0.1", port)).close()
+                    break
+                except ConnectionRefusedError:
+                    assert time.monotonic() < deadline
+                    time.sleep(0.02)
+
+        yield ["127.0.0.1:%d" % port for port in ports]
+    finally:
+        for process in processes:
+            process.terminate()
+            process.wait()
+
+
+def test_client(nodes):
+    client = Client(nodes, pool_size=2)
+
+    assert client.get("foo") is None
+    assert client.remaining("foo") is None
+
+    assert [client.hit("foo") for _ in range(4)] == [True, True, True, False]
+    assert 0 < client.get("foo") <= 60
+    assert client.remaining("foo") == 0
+
+    assert client.delete("foo")
+    assert not client.delete("foo")
+    assert client.hit("foo")
+
+    # Keys are spread over all the nodes, one connection each (reused)
+    for key in KEYS[:100]:
+        assert client.hit(key)
+
+    assert sorted(client._pools) == sorted(map(parse_address, nodes))
+    assert all(len(pool) == 1 for pool in client._pools.values())
+
+    client.close()
+    assert not any(client._pools.values())
+
+    with pytest.raises(ValueError):
+        client.hit("foo bar")
+
+
+def test_client_stale_connection(nodes):
+    client = Client(nodes, pool_size=2)
+    assert client.hit("foo")
+
+    # As if the node was restarted, the idle connection is replaced
+    (connection,) = client._pools[client.cluster.address("foo")]
+    connection.sock.shutdown(socket.SHUT_RDWR)
+
+    assert client.hit("foo")
+    assert client._pools[client.cluster.address("foo")] != [connection]
+    assert client.remaining("foo") == 1
+
+    client.close()
+
+
+def test_client_redirect(nodes):
+    # A client that does not know the third node yet is redirected
+    client = Client(nodes, pool_size=2)
+    stale = Client(nodes[:2], pool_size=2)
+
+    keys = [key for key in KEYS[:100] if jump_hash(key, 3) == 2]
+    assert keys
+
+    for key in keys:
+        assert stale.hit(key)
+
+    for key in keys:
+        assert client.remaining(key) == 2
+
+    # Redirections are only followed max_redirects times
+    stale.max_redirects = 0
+    with pytest.raises(ServerError, match="too many redirections"):
+        stale.hit(keys[0])
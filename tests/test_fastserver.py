@@ -0,0 +1,273 @@
+import socket
+import threading
+import time
+
+import pytest
+
+from pyrated.fastserver import (
+    SelectorServer,
+    bind_datagram_sockets,
+    bind_sockets,
+    bind_unix_socket,
+)
+from pyrated.protocol import UDP_HEADER, MemcachedDatagramProtocol
+from pyrated.ratelimit import Ratelimit
+from pyrated.server import MemcachedServerProtocol
+from pyrated.stats import Stats
+
+
+@pytest.fixture
+def start_server():
+    """
+    Start a SelectorServer (same arguments) in a thread, stopped at teardown
+
+    """
+    started = []
+
+    def start(*args, **kwargs):
+        server = SelectorServer(*args, **kwargs)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        started.append((server, thread))
+        return server
+
+    yield start
+
+    for server, thread in started:
+        server.stop()
+        thread.join(1)
+        assert not thread.is_alive()
+
+
+@pytest.fixture
+def server(start_server, unused_tcp_port):
+    protocol_class = MemcachedServerProtocol.create_class(Ratelimit(1, 2))
+    return start_server(protocol_class, bind_sockets(["127.0.0.1"], unused_tcp_port))
+
+
+def connect(server):
+    address = server.sockets[0].getsockname()
+    sock = socket.create_connection(address, timeout=1)
+    return sock
+
+
+def read_until(sock, end):
+    data = b""
+    while not data.endswith(end):
+        chunk = sock.recv(4096)
+        if not chunk:
+            break
+        data += chunk
+    return data
+
+
+def test_incr(server):
+    sock = connect(server)
+
+    sock.sendall(b"incr foo\r\n")
+    assert read_until(sock, b"\r\n") == b"0\r\n"
+
+    sock.sendall(b"incr foo\r\n")
+    assert read_until(sock, b"\r\n") == b"1\r\n"
+
+    sock.close()
+
+
+def test_pipelined(server):
+    sock = connect(server)
+
+    sock.sendall(b"incr foo\r\nincr bar\r\nincr foo noreply\r\nincr foo\r\n")
+    assert read_until(sock, b"0\r\n0\r\n1\r\n") == b"0\r\n0\r\n1\r\n"
+
+    sock.sendall(b"delete foo\r\nget foo\r\n")
+    assert read_until(sock, b"END\r\n") == b"DELETED\r\nEND\r\n"
+
+    sock.close()
+
+
+def test_partial_lines(server):
+    sock = connect(server)
+
+    sock.sendall(b"inc")
+    sock.sendall(b"r foo\r")
+    sock.sendall(b"\n")
+    assert read_until(sock, b"\r\n") == b"0\r\n"
+
+    sock.close()
+
+
+def test_shared_state(server):
+    sock1 = connect(server)
+    sock2 = connect(server)
+
+    sock1.sendall(b"incr foo\r\n")
+    assert read_until(sock1, b"\r\n") == b"0\r\n"
+
+    sock2.sendall(b"incr foo\r\n")
+    assert read_until(sock2, b"\r\n") == b"1\r\n"
+
+    sock1.close()
+    sock2.close()
+
+
+def test_big_line(server):
+    sock = connect(server)
+
+    sock.sendall(b"incr foo\r\nincr foo\r\nincr " + b"b" * 10000)
+    assert read_until(sock, b"long\r\n") == (
+        b"0\r\n1\r\nCLIENT_ERROR line too long\r\n"
+    )
+
+    # Then closed
+    assert sock.recv(16) == b""
+
+    sock.close()
+
+
+def test_malformed_lines(server):
+    sock = connect(server)
+
+    sock.sendall(b"incr\r\nincr \xff\r\nincr foo\r\n")
+    assert read_until(sock, b"0\r\n") == b"ERROR\r\nERROR\r\n0\r\n"
+
+    sock.close()
+
+
+@pytest.mark.parametrize("deferred", [False, True])
+def test_protocol_error(server, caplog, monkeypatch, deferred):
+    if deferred:
+        # The error happens in a callback scheduled by the protocol
+        server.protocol_class.read_budget = 1
+
+    handle_line = server.protocol_class.handle_line
+
+    def failing(protocol, line):
+        if line == "boom":
+            raise RuntimeError("boom")
+        return handle_line(protocol, line)
+
+    monkeypatch.setattr(server.protocol_class, "handle_line", failing)
+
+    sock = connect(server)
+    sock.sendall(b"incr foo\r\nboom\r\nincr foo\r\n")
+
+    # Only that connection is closed
+    assert read_until(sock, b"\r\n\r\n") == b"0\r\n"
+    sock.close()
+
+    sock = connect(server)
+    sock.sendall(b"incr foo\r\n")
+    assert read_until(sock, b"\r\n") == b"1\r\n"
+    sock.close()
+
+    assert "Error handling a connection" in caplog.text
+
+
+def test_unix_socket(start_server, tmp_path):
+    path = str(tmp_path / "pyrated.sock")
+    protocol_class = MemcachedServerProtocol.create_class(Ratelimit(1, 2))
+    start_server(protocol_class, [bind_unix_socket(path)])
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(1)
+    sock.connect(path)
+
+    sock.sendall(b"incr foo\r\nincr foo\r\n")
+    assert read_until(sock, b"0\r\n1\r\n") == b"0\r\n1\r\n"
+    sock.close()
+
+
+def test_datagram(start_server, unused_tcp_port, unused_udp_port):
+    rlist = Ratelimit(1, 2)
+    protocol_class = MemcachedServerProtocol.create_class(rlist)
+    datagram_class = MemcachedDatagramProtocol.create_class(rlist)
+
+    datagrams = [
+        datagram_class(sock)
+        for sock in bind_datagram_sockets(["127.0.0.1"], unused_udp_port)
+    ]
+    start_server(
+        protocol_class, bind_sockets(["127.0.0.1"], unused_tcp_port), datagrams
+    )
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.settimeout(1)
+    sock.connect(("127.0.0.1", unused_udp_port))
+
+    sock.send(UDP_HEADER.pack(1, 0, 1, 0) + b"incr foo\r\nincr foo\r\n")
+    assert sock.recv(1500) == UDP_HEADER.pack(1, 0, 1, 0) + b"0\r\n1\r\n"
+    sock.close()
+
+
+def test_slow_reader(start_server, unused_tcp_port):
+    base = MemcachedServerProtocol.create_class(
+        Ratelimit(10, 1), write_high_water=4096, write_low_water=1024
+    )
+
+    class SmallBufferProtocol(base):
+        def connection_made(self, transport):
+            transport.sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 4096)
+            super().connection_made(transport)
+
+    server = start_server(
+        SmallBufferProtocol, bind_sockets(["127.0.0.1"], unused_tcp_port)
+    )
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+    sock.settimeout(5)
+    sock.connect(("127.0.0.1", unused_tcp_port))
+
+    count = 100000
+    sender = threading.Thread(target=sock.sendall, args=(b"incr foo\r\n" * count,))
+    sender.start()
+
+    # The client does not read, the server stops once its buffer is full
+    deadline = time.monotonic() + 5
+    while not any(
+        connection.write_paused and not connection.reading
+        for connection in list(server.connections)
+    ):
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+    (connection,) = server.connections
+    assert len(connection.wbuffer) <= 4096 + 3
+
+    data = b""
+    while len(data) < count * 3:
+        data += sock.recv(65536)
+    assert data.startswith(b"0\r\n" * 10 + b"1\r\n")
+
+    sender.join(1)
+    sock.close()
+
+
+def test_stats(start_server, unused_tcp_port):
+    rlist = Ratelimit(1, 2)
+    stats = Stats(rlist, lag_interval=0.01, sample=1)
+    protocol_class = MemcachedServerProtocol.create_class(rlist, stats=stats)
+    server = start_server(protocol_class, bind_sockets(["127.0.0.1"], unused_tcp_port))
+
+    sock = connect(server)
+    sock.sendall(b"incr foo\r\nstats detail\r\n")
+    data = read_until(sock, b"END\r\n")
+    sock.close()
+
+    assert b"STAT cmd_incr:count 1\r\n" in data
+
+    deadline = time.monotonic() + 5
+    while not stats.lag.count:
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+def test_stop_before_serving(unused_tcp_port):
+    protocol_class = MemcachedServerProtocol.create_class(Ratelimit(1, 2))
+    server = SelectorServer(
+        protocol_class, bind_sockets(["127.0.0.1"], unused_tcp_port)
+    )
+
+    # A signal received right after binding, the server does not start
+    server.stop()
+    server.serve_forever()
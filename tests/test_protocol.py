@@ -3,14 +3,20 @@ import unittest.mock
 
 import pytest
 
-from pyrated.ratelimit import Ratelimit
+from pyrated.cluster import Cluster
+from pyrated.protocol import UDP_HEADER, MemcachedDatagramProtocol
+from pyrated.ratelimit import Ratelimit, key_hash
 from pyrated.server import MemcachedServerProtocol
+from pyrated.stats import Stats
 
 
-class TestProtocol:
+class ProtocolTestCase:
+    options = {}  # create_class options of the tested protocol class
+
     @pytest.fixture(autouse=True)
     def mock_protocol(self):
-        protocol = MemcachedServerProtocol.create_class(Ratelimit(1, 2))
+        self.rlist = Ratelimit(1, 2)
+        protocol = MemcachedServerProtocol.create_class(self.rlist, **self.options)
 
         self.mprotocol = protocol()
         self.mbuffer = io.BytesIO()
@@ -30,6 +36,8 @@ class TestProtocol:
             self.mbuffer.truncate()
         return ret
 
+
+class TestProtocol(ProtocolTestCase):
     def test_get_empty(self):
         self.write(b"get foo\r\n")
         assert self.read() == b"END\r\n"
@@ -74,6 +82,25 @@ class TestProtocol:
 
         assert lines[6] == "END"
 
+    def test_gets(self):
+        self.write(b"incr foo\r\n")
+        self.read()
+
+        self.write(b"gets foo bar\r\n")
+        lines = self.read().decode().split("\r\n")
+
+        # cas is the number of remaining hits
+        assert lines[0].startswith("VALUE foo 0 5 ")
+        assert lines[0].endswith(" 0")
+        assert 1.9 < float(lines[1]) <= 2.0
+        assert lines[2:] == ["END", ""]
+
+    def test_gets_remaining(self):
+        self.mprotocol.rlist = Ratelimit(3, 2)
+        self.write(b"incr foo\r\ngets foo\r\n")
+
+        assert self.read() == b"0\r\nVALUE foo 0 5 2\r\n0.000\r\nEND\r\n"
+
     def test_get_incr_noreply(self):
         # first don't reply
         self.write(b"incr foo noreply\r\n")
@@ -112,8 +139,9 @@ class TestProtocol:
 
     def test_big_line(self):
         data = "incr " + ("b" * 10000)
-        self.write(data.encode())
+        self.write(b"incr foo\r\n" + data.encode())
 
+        assert self.read() == b"0\r\nCLIENT_ERROR line too long\r\n"
         self.mprotocol.transport.close.assert_called_with()
 
 
@@ -125,3 +153,448 @@ def test_create_protocol_class():
     cls2 = MemcachedServerProtocol.create_class(rl2)
 
     assert cls1.rlist is not cls2.rlist
+
+
+class TestDatagramProtocol:
+    @pytest.fixture(autouse=True)
+    def mock_protocol(self):
+        protocol = MemcachedDatagramProtocol.create_class(Ratelimit(1, 2))
+
+        self.received = []
+        self.sent = []
+
+        def recvfrom(size):
+            if not self.received:
+                raise BlockingIOError
+            return self.received.pop(0)
+
+        mock = unittest.mock.Mock()
+        mock.recvfrom = recvfrom
+        mock.sendto = lambda data, address: self.sent.append((data, address))
+
+        self.mprotocol = protocol(mock)
+
+    def write(self, *datagrams, request_id=1, address=("127.0.0.1", 4242)):
+        for data in datagrams:
+            header = UDP_HEADER.pack(request_id, 0, 1, 0)
+            self.received.append((header + data, address))
+            request_id += 1
+
+        self.mprotocol.read_ready()
+
+    def read(self):
+        ret = [
+            (UDP_HEADER.unpack_from(data), data[UDP_HEADER.size :], address)
+            for data, address in self.sent
+        ]
+        self.sent.clear()
+        return ret
+
+    def test_incr(self):
+        self.write(b"incr foo\r\n", request_id=42)
+        assert self.read() == [((42, 0, 1, 0), b"0\r\n", ("127.0.0.1", 4242))]
+
+        self.write(b"incr foo\r\n", request_id=43)
+        assert self.read() == [((43, 0, 1, 0), b"1\r\n", ("127.0.0.1", 4242))]
+
+    def test_batch(self):
+        calls = []
+        hit_many = self.mprotocol.rlist.hit_many
+
+        def record(keys):
+            calls.append(list(keys))
+            return hit_many(keys)
+
+        self.mprotocol.rlist.hit_many = record
+
+        self.write(
+            b"incr foo\r\nincr bar\r\n", b"incr foo\r\n", b"incr baz noreply\r\n"
+        )
+
+        # A single call for all the datagrams
+        assert calls == [["foo", "bar", "foo", "baz"]]
+        assert [(header[0], data) for header, data, _ in self.read()] == [
+            (1, b"0\r\n0\r\n"),
+            (2, b"1\r\n"),
+        ]
+        assert "baz" in self.mprotocol.rlist
+
+    def test_noreply(self):
+        self.write(b"incr foo noreply\r\n")
+        assert self.read() == []
+
+        self.write(b"incr foo\r\n")
+        assert self.read()[0][1] == b"1\r\n"
+
+    def test_ordering(self):
+        self.write(b"incr foo\r\nincr foo\r\ndelete foo\r\nincr foo\r\n")
+        assert self.read()[0][1] == b"0\r\n1\r\nDELETED\r\n0\r\n"
+
+    def test_errors(self):
+        self.write(b"set foo 0 0 3\r\nincr\r\ndelete\r\n\xff\r\n")
+        assert self.read()[0][1] == b"ERROR\r\n" * 4
+
+    def test_invalid_frames(self):
+        # Too short, or spanning multiple datagrams
+        self.received.append((b"\x00\x01", ("127.0.0.1", 4242)))
+        self.received.append(
+            (UDP_HEADER.pack(1, 0, 2, 0) + b"incr foo\r\n", ("127.0.0.1", 4242))
+        )
+        self.mprotocol.read_ready()
+
+        assert self.read() == []
+        assert "foo" not in self.mprotocol.rlist
+
+    def test_key_hash(self):
+        self.mprotocol.key_hash = True
+        self.write(b"incr foo\r\n")
+        assert "foo" not in self.mprotocol.rlist
+        assert len(self.mprotocol.rlist) == 1
+
+        self.write(b"delete foo\r\n")
+        assert [data for _, data, _ in self.read()] == [b"0\r\n", b"DELETED\r\n"]
+        assert len(self.mprotocol.rlist) == 0
+
+    def test_stats(self):
+        stats = self.mprotocol.stats = Stats(self.mprotocol.rlist)
+        self.write(b"incr foo\r\nincr bar\r\n", b"incr foo\r\n")
+
+        assert [data for _, data, _ in self.read()] == [b"0\r\n0\r\n", b"1\r\n"]
+        assert stats.batch.count == 1
+        assert stats.ratelimit.count == 1
+
+    def test_no_amplification(self):
+        self.write(b"incr foo\r\n")
+        self.read()
+
+        # Replies larger than their request are not served over UDP
+        self.write(b"get foo\r\n", b"gets foo\r\n", b"stats detail\r\n")
+        assert [data for _, data, _ in self.read()] == [b"ERROR\r\n"] * 3
+
+        self.write(b"delete f\r\n", b"x\n")
+        assert self.read() == []
+
+        self.write(b"delete fo\r\n")
+        assert self.read()[0][1] == b"NOT_FOUND\r\n"
+
+
+class TestKeyHash(ProtocolTestCase):
+    options = {"key_hash": True, "key_seed": 42}
+
+    def test_hashed_keys(self):
+        key = "https://example.com/" + "x" * 1000
+        self.write(b"incr foo\r\nincr %s\r\n" % key.encode())
+        self.read()
+
+        assert list(self.mprotocol.rlist) == [key_hash("foo", 42), key_hash(key, 42)]
+
+        # Replies still use the keys sent
+        self.write(b"get %s\r\n" % key.encode())
+        assert self.read().startswith(b"VALUE %s 0 " % key.encode())
+
+        self.write(b"delete %s\r\nget %s\r\n" % (key.encode(), key.encode()))
+        assert self.read() == b"DELETED\r\nEND\r\n"
+        assert list(self.mprotocol.rlist) == [key_hash("foo", 42)]
+
+    def test_key_hash(self):
+        # XXH64 reference values
+        assert key_hash("") == 0xEF46DB3751D8E999
+        assert key_hash(b"abc") == key_hash("abc") == 0x44BC2CF5AD770999
+        assert key_hash("Nobody inspects the spammish repetition") == (
+            0xFBCEA83C8A378BF1
+        )
+        assert key_hash("abc", 1) != key_hash("abc")
+
+
+class TestStats(ProtocolTestCase):
+    @property
+    def options(self):
+        return {"stats": Stats(self.rlist, sample=1), "admin": True}
+
+    def stats(self):
+        self.write(b"stats detail\r\n")
+        lines = self.read().decode().split("\r\n")
+        assert lines[-2:] == ["END", ""]
+
+        return dict(line.split(" ")[1:] for line in lines[:-2])
+
+    def test_stats_detail(self):
+        self.write(b"incr foo\r\nincr foo\r\nget foo\r\nfoo\r\nlimit\r\n")
+        self.read()
+
+        stats = self.stats()
+        assert stats["cmd_incr:count"] == "2"
+        assert stats["cmd_get:count"] == "1"
+        assert stats["cmd_limit:count"] == "1"
+        assert stats["cmd_unknown:count"] == "1"
+        assert stats["stage_parse:count"] == "5"
+        assert stats["stage_ratelimit:count"] == "3"
+        assert "cmd_delete:count" not in stats
+
+        assert float(stats["cmd_incr:min_us"]) <= float(stats["cmd_incr:p50_us"])
+        assert float(stats["cmd_incr:p99.9_us"]) <= float(stats["cmd_incr:max_us"])
+
+        # The previous stats command was recorded too
+        assert self.stats()["cmd_stats:count"] == "1"
+
+        self.write(b"stats reset\r\n")
+        assert self.read() == b"RESET\r\n"
+        assert "cmd_incr:count" not in self.stats()
+
+    def test_stats_dump(self):
+        self.write(b"incr foo\r\n")
+
+        output = io.StringIO()
+        self.mprotocol.stats.dump(output)
+        assert "cmd_incr:count 1\n" in output.getvalue()
+
+    def test_stats_sample(self):
+        self.mprotocol.stats.sample = 4
+        self.write(b"incr foo\r\n" * 10)
+        self.read()
+
+        # The first line is timed, then one line out of 4
+        stats = self.stats()
+        assert stats["cmd_incr:count"] == "3"
+        assert stats["stage_ratelimit:count"] == "10"
+
+    def test_stats_invalid(self):
+        self.write(b"stats foo\r\n")
+        assert self.read() == b"ERROR unknown command\r\n"
+
+
+def test_stats_disabled():
+    protocol = MemcachedServerProtocol.create_class(Ratelimit(1, 2))()
+    assert protocol.stats_reply(["detail"]) == (
+        b"SERVER_ERROR instrumentation disabled\r\n"
+    )
+
+
+class TestAdmin(ProtocolTestCase):
+    options = {"admin": True}
+
+    def test_limit(self):
+        self.write(b"limit\r\n")
+        assert self.read() == b"LIMIT 1/2\r\n"
+
+        self.write(b"incr foo\r\nincr foo\r\n")
+        assert self.read() == b"0\r\n1\r\n"
+
+        # The previous hit is kept
+        self.write(b"limit 3/1m\r\nincr foo\r\nincr foo\r\nincr foo\r\n")
+        assert self.read() == b"LIMIT 3/60\r\n0\r\n0\r\n1\r\n"
+
+        self.write(b"limit 10/1000000\r\nlimit 10/24d\r\n")
+        assert self.read() == b"LIMIT 10/1000000\r\nLIMIT 10/2073600\r\n"
+
+    def test_limit_invalid(self):
+        for definition in (b"foo", b"5/1.5", b"5/3xyz"):
+            self.write(b"limit %s\r\n" % definition)
+            assert self.read() == (
+                b"CLIENT_ERROR invalid definition '%s' (hits/period)\r\n" % definition
+            )
+
+        self.write(b"limit 0/1\r\n")
+        assert self.read() == b"CLIENT_ERROR count must be greater than 0 (0)\r\n"
+
+        self.write(b"limit 99999999999/1\r\n")
+        assert self.read() == (
+            b"CLIENT_ERROR maximum count is 2**31 - 1 (99999999999)\r\n"
+        )
+
+        self.write(b"limit 1/25d\r\n")
+        assert self.read() == b"CLIENT_ERROR maximum period is 24 days (2160000)\r\n"
+
+        self.write(b"limit\r\n")
+        assert self.read() == b"LIMIT 1/2\r\n"
+
+
+def test_limit_not_admin():
+    protocol = MemcachedServerProtocol.create_class(Ratelimit(1, 2))()
+    transport = unittest.mock.Mock()
+    protocol.connection_made(transport)
+
+    protocol.data_received(b"limit 5/1\r\n")
+    transport.write.assert_called_once_with(b"ERROR unknown command\r\n")
+    assert protocol.rlist.count == 1
+
+
+class TestCluster(ProtocolTestCase):
+    # Of a 2 nodes ring, foo and baz belong to node 0, bar and qux to node 1
+    options = {"cluster": Cluster(["127.0.0.1:11211", "[::1]:11212"], 0)}
+
+    def test_local(self):
+        self.write(b"incr foo\r\nincr foo\r\nincr baz\r\ndelete baz\r\n")
+        assert self.read() == b"0\r\n1\r\n0\r\nDELETED\r\n"
+
+        self.write(b"gets foo\r\n")
+        assert self.read().startswith(b"VALUE foo 0 5 0\r\n")
+
+    def test_moved(self):
+        moved = b"SERVER_ERROR moved [::1]:11212\r\n"
+
+        self.write(b"incr bar\r\nincr bar noreply\r\nget bar qux\r\ndelete bar\r\n")
+        assert self.read() == moved * 3
+
+        # Nothing was recorded
+        assert "bar" not in self.mprotocol.rlist
+
+    def test_no_keys(self):
+        self.write(b"get\r\ngets\r\n")
+        assert self.read() == b"END\r\n" * 2
+
+    def test_moved_multiple_nodes(self):
+        # Not redirected, the other node would redirect back
+        self.write(b"incr foo\r\nget foo qux\r\ngets qux foo\r\n")
+        assert self.read() == (
+            b"0\r\n" + b"CLIENT_ERROR keys belong to different nodes\r\n" * 2
+        )
+
+    def test_datagram(self):
+        cluster = Cluster(["127.0.0.1:11211", "127.0.0.1:11212"], 1)
+        protocol = MemcachedDatagramProtocol.create_class(
+            Ratelimit(1, 2), cluster=cluster
+        )
+
+        header = UDP_HEADER.pack(1, 0, 1, 0)
+        sock = unittest.mock.Mock()
+        protocol(sock).handle_batch(
+            [
+                (header + b"incr foo\r\nincr bar\r\n", "client"),
+                (header + b"incr a-long-key-owned-by-node-0-0\r\nincr qux\r\n", "b"),
+            ]
+        )
+
+        # The first reply would be larger than its request (no amplification)
+        sock.sendto.assert_called_once_with(
+            header + b"SERVER_ERROR moved 127.0.0.1:11211\r\n0\r\n", "b"
+        )
+
+
+def test_create_protocol_class_options():
+    cls = MemcachedServerProtocol.create_class(Ratelimit(1, 2), read_budget=5)
+    assert cls.read_budget == 5
+    assert MemcachedServerProtocol.read_budget != 5
+
+    with pytest.raises(TypeError):
+        MemcachedServerProtocol.create_class(Ratelimit(1, 2), foo=5)
+
+
+class TestBackpressure:
+    @pytest.fixture(autouse=True)
+    def mock_protocol(self):
+        protocol = MemcachedServerProtocol.create_class(
+            Ratelimit(10, 2), read_budget=2, write_high_water=10, write_low_water=5
+        )
+
+        self.mprotocol = protocol()
+        self.mbuffer = io.BytesIO()
+        self.scheduled = []
+        self.mprotocol.schedule = self.scheduled.append
+
+        self.transport = unittest.mock.Mock()
+        self.transport.write = self.mbuffer.write
+
+        self.mprotocol.connection_made(self.transport)
+
+    def read(self):
+        ret = self.mbuffer.getvalue()
+        self.mbuffer.seek(0)
+        self.mbuffer.truncate()
+        return ret
+
+    def run_scheduled(self):
+        callback = self.scheduled.pop(0)
+        assert not self.scheduled
+        callback()
+
+    def test_write_buffer_limits(self):
+        self.transport.set_write_buffer_limits.assert_called_once_with(10, 5)
+
+    def test_read_budget(self):
+        self.mprotocol.data_received(b"incr a\r\n" * 5)
+
+        assert self.read() == b"0\r\n" * 2
+        self.transport.pause_reading.assert_called_once_with()
+
+        self.run_scheduled()
+        assert self.read() == b"0\r\n" * 2
+        assert not self.transport.resume_reading.called
+
+        self.run_scheduled()
+        assert self.read() == b"0\r\n"
+        self.transport.resume_reading.assert_called_once_with()
+        assert not self.scheduled
+
+    def test_pause_writing(self):
+        self.mprotocol.pause_writing()
+        self.transport.pause_reading.assert_called_once_with()
+
+        # Lines already received are kept for later
+        self.mprotocol.data_received(b"incr a\r\nincr b\r\n")
+        assert self.read() == b""
+        assert not self.scheduled
+
+        self.mprotocol.resume_writing()
+        assert self.read() == b"0\r\n0\r\n"
+        self.transport.resume_reading.assert_called_once_with()
+
+    def test_pause_writing_while_handling(self):
+        def write(data):
+            self.mbuffer.write(data)
+            self.mprotocol.pause_writing()
+
+        self.transport.write = write
+        self.mprotocol.data_received(b"incr a\r\nincr b\r\n")
+
+        # Stopped right after the first reply
+        assert self.read() == b"0\r\n"
+        assert not self.scheduled
+
+        self.transport.write = self.mbuffer.write
+        self.mprotocol.resume_writing()
+        assert self.read() == b"0\r\n"
+
+    def test_connection_lost(self):
+        self.mprotocol.data_received(b"incr a\r\n" * 5)
+        self.read()
+
+        self.mprotocol.connection_lost(None)
+        self.run_scheduled()
+
+        assert self.read() == b""
+        assert not self.scheduled
+
+    def test_invalid_lines(self):
+        # Handled from a scheduled callback too
+        self.mprotocol.data_received(b"incr a\r\nincr a\r\nincr\r\nincr \xff\r\n")
+        assert self.read() == b"0\r\n0\r\n"
+
+        self.run_scheduled()
+        assert self.read() == b"ERROR\r\nERROR\r\n"
+        self.transport.resume_reading.assert_called_once_with()
+
+    def test_big_line(self):
+        self.mprotocol.data_received(b"incr a\r\n" * 3 + b"incr " + b"x" * 9000)
+
+        # The complete lines are answered first, even across callbacks
+        assert self.read() == b"0\r\n" * 2
+        assert not self.transport.close.called
+
+        self.mprotocol.data_received(b"incr a\r\n")
+        self.run_scheduled()
+        assert self.read() == b"0\r\nCLIENT_ERROR line too long\r\n"
+        self.transport.close.assert_called_once_with()
+        assert not self.scheduled
+
+    def test_unexpected_error(self):
+        self.mprotocol.data_received(b"incr a\r\n" * 3)
+        self.read()
+
+        self.mprotocol.handle_incr = unittest.mock.Mock(side_effect=RuntimeError)
+        with pytest.raises(RuntimeError):
+            self.run_scheduled()
+
+        # The connection is closed instead of hanging, paused
+        self.transport.close.assert_called_once_with()
+        assert not self.mprotocol.pending
@@ -1,10 +1,13 @@
 import asyncio
 import pickle
+import threading
 import unittest
 import weakref
 from time import sleep
 
-from pyrated._ratelimit import _get_fake_now, _set_fake_now
+import pytest
+
+from pyrated._ratelimit import Histogram, _get_fake_now, _set_fake_now
 from pyrated.ratelimit import Ratelimit
 
 
@@ -293,3 +296,422 @@ class TestRatelimit(unittest.TestCase):
 
         assert ref() is None
         assert task_count(loop) == 0
+
+    def test_hit_many(self):
+        rl = Ratelimit(2, 10)
+
+        with FakeTime():
+            assert rl.hit_many(["a", "b", "a", "a"]) == [True, True, True, False]
+            assert rl.hit_many(()) == []
+            assert rl.hit("b") is True
+            assert rl.hit_many(["b"]) == [False]
+
+        with self.assertRaises(TypeError):
+            rl.hit_many(42)
+
+        with self.assertRaises(TypeError):
+            rl.hit_many([["unhashable"]])
+
+    def test_get_many(self):
+        # 3 hits over 10 seconds
+        rl = Ratelimit(3, 10)
+
+        with FakeTime() as fake:
+            assert rl.get_many(["foo"]) == [(False, 3, 0)]
+
+            rl.hit("foo")
+            fake += 1000
+            rl.hit("foo")
+            assert rl.get_many(("foo", "bar")) == [(True, 1, 0), (False, 3, 0)]
+
+            fake += 1000
+            rl.hit("foo")
+            assert rl.hit("foo") is False
+            assert rl.get_many(["foo"]) == [(True, 0, 8000)]
+
+            # First hit expired
+            fake += 8000
+            assert rl.get_many(["foo"]) == [(True, 1, 0)]
+
+            # Ring wrapped around
+            assert rl.hit("foo") is True
+            assert rl.get_many(["foo"]) == [(True, 0, 1000)]
+
+            fake += 1000
+            assert rl.get_many(["foo"]) == [(True, 1, 0)]
+
+            fake += 10000
+            assert rl.get_many(["foo"]) == [(True, 3, 0)]
+
+        with self.assertRaises(TypeError):
+            rl.get_many(42)
+
+    def test_get_many_block_size(self):
+        # Partially allocated entries
+        rl = Ratelimit(10, 10, block_size=3)
+
+        with FakeTime() as fake:
+            for i in range(5):
+                rl.hit("foo")
+                assert rl.get_many(["foo"]) == [(True, 9 - i, 0)]
+                fake += 1000
+
+            # Hits made at 1, 2 seconds expired
+            fake += 6000
+            assert rl.get_many(["foo"]) == [(True, 7, 0)]
+
+    def test_threads(self):
+        # Hits from many threads, on shared and distinct keys
+        rl = Ratelimit(1000, 100)
+        results = []
+
+        def worker(name):
+            shared = [rl.hit("shared") for _ in range(500)]
+            own = rl.hit_many([name] * 1500)
+            results.append((shared.count(True), own.count(True)))
+
+        threads = [
+            threading.Thread(target=worker, args=("key%d" % i,)) for i in range(8)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert sum(shared for shared, _ in results) == 1000
+        assert [own for _, own in results] == [1000] * 8
+        assert len(rl) == 9
+
+    def test_reconfigure_threads(self):
+        # Reconfigurations while other threads hit the list
+        rl = Ratelimit(100, 100)
+        done = threading.Event()
+
+        def worker(name):
+            while not done.is_set():
+                rl.hit_many([name, "shared"] * 50)
+                rl.get_many([name, "shared"])
+
+        threads = [
+            threading.Thread(target=worker, args=("key%d" % i,)) for i in range(4)
+        ]
+        for thread in threads:
+            thread.start()
+        for count in (5, 200, 1, 50) * 10:
+            rl.reconfigure(count, 100)
+            sleep(0.001)
+        done.set()
+        for thread in threads:
+            thread.join()
+
+        for exists, remaining, next_hit in rl.get_many(rl):
+            assert 0 <= remaining <= 50
+            assert (remaining == 0) == (next_hit > 0)
+        assert max(entry.__getstate__()[3] for entry in rl._entries.values()) <= 50
+
+    def test_cleanup_thread(self):
+        rl = Ratelimit(10, 0.01)
+        rl.hit("foo")
+
+        thread = rl.install_cleanup_thread(0.005)
+        sleep(0.05)
+        assert len(rl) == 0
+
+        rl.remove_cleanup()
+        thread.join(1)
+        assert not thread.is_alive()
+
+    def test_cleanup_thread_reference(self):
+        rl = Ratelimit(10, 10)
+        ref = weakref.ref(rl)
+
+        thread = rl.install_cleanup_thread(0.005)
+        del rl
+
+        thread.join(1)
+        assert ref() is None
+        assert not thread.is_alive()
+
+    def test_growth(self):
+        base = Ratelimit(100, 10, block_size=10)
+        assert base.growth == 2.0
+
+        sizes = []
+        with FakeTime():
+            for _ in range(100):
+                base.hit("foo")
+                size = base._entries["foo"].__getstate__()[3]
+                if not sizes or sizes[-1] != size:
+                    sizes.append(size)
+
+        assert sizes == [10, 20, 40, 80, 100]
+
+        base = Ratelimit(25, 10, block_size=10, growth=1.0)
+        sizes = []
+        with FakeTime():
+            for _ in range(25):
+                base.hit("foo")
+                size = base._entries["foo"].__getstate__()[3]
+                if not sizes or sizes[-1] != size:
+                    sizes.append(size)
+
+        assert sizes == [10, 20, 25]
+
+        with self.assertRaises(TypeError):
+            base.growth = "foo"
+
+        with self.assertRaises(ValueError):
+            base.growth = 0.5
+
+    def test_pool_recycling(self):
+        rl = Ratelimit(100, 10, block_size=10)
+
+        with FakeTime() as fake:
+            for key in range(50):
+                for _ in range(100):
+                    rl.hit(key)
+
+            # Smaller rings given back when an entry grows are reused
+            # by the next one, only the full size rings were allocated
+            stats = rl._pool_stats()
+            assert stats["allocated"] == 5 + 49
+            assert stats["reused"] == 49 * 4
+            assert stats["cached"] == 4
+
+            fake += 10000
+            rl.cleanup()
+            assert rl._pool_stats()["cached"] == 4 + 50
+
+            # New entries only use recycled memory
+            for key in range(50, 100):
+                for _ in range(100):
+                    assert rl.hit(key) is True
+                assert rl.hit(key) is False
+
+            stats = rl._pool_stats()
+            assert stats["allocated"] == 5 + 49
+            assert stats["reused"] == 49 * 4 + 50 * 5
+            assert stats["cached"] == 4
+
+            # Removed entries too
+            rl.remove(50)
+            assert rl._pool_stats()["cached"] == 5
+
+    def test_compact(self):
+        rl = Ratelimit(100, 10, block_size=10)
+
+        def csize(key):
+            return rl._entries[key].__getstate__()[3]
+
+        with FakeTime() as fake:
+            for _ in range(100):
+                rl.hit("foo")
+                rl.hit("bar")
+                fake += 10
+            rl.hit("baz")
+            assert csize("foo") == 100
+
+            # Only the 3 last hits of foo and bar are still in the period
+            fake.value = 1000 + 990 + 10000 - 25
+            next_hit = rl.next_hit("foo")
+
+            assert rl.compact(2) == (2, 2)
+            assert rl.compact(2) == (1, 0)
+            assert csize("foo") == csize("bar") == 10
+            assert csize("baz") == 10
+
+            # Same behavior as before compaction
+            assert rl.next_hit("foo") == next_hit
+            assert rl.get_many(["foo"]) == [(True, 97, 0)]
+            for _ in range(97):
+                assert rl.hit("foo") is True
+            assert rl.hit("foo") is False
+            assert csize("foo") == 100
+
+            # Nothing left to compact, and the rings went back to the pool
+            assert rl.compact(100) == (3, 0)
+            assert rl._pool_stats()["cached"] > 0
+
+    def test_compact_threshold(self):
+        # Shrunk when the size fitting the live hits is at most half of it
+        rl = Ratelimit(100, 10, block_size=10, growth=1.0)
+        sizes = [(20, 10), (30, 11), (40, 11)]  # (total, live) hits
+
+        def csize(key):
+            return rl._entries[key].__getstate__()[3]
+
+        with FakeTime() as fake:
+            for key, (total, live) in enumerate(sizes):
+                for _ in range(total - live):
+                    rl.hit(key)
+            fake += 9000
+            for key, (total, live) in enumerate(sizes):
+                for _ in range(live):
+                    rl.hit(key)
+            fake += 1001
+
+            assert [csize(key) for key in range(3)] == [20, 30, 40]
+            assert rl.compact(10) == (3, 2)
+            assert [csize(key) for key in range(3)] == [10, 30, 20]
+
+    def test_compact_cleanup_task(self):
+        rl = Ratelimit(100, 10, block_size=10)
+        rl.compact_budget = 2
+
+        with FakeTime() as fake:
+            for key in range(5):
+                for _ in range(50):
+                    rl.hit(key)
+            fake += 9000
+            for key in range(5):
+                rl.hit(key)
+            fake += 1001
+
+            loop = asyncio.new_event_loop()
+            try:
+                task = rl.install_cleanup(loop, 0)
+                for _ in range(10):
+                    loop.run_until_complete(asyncio.sleep(0))
+                task.cancel()
+                loop.run_until_complete(asyncio.sleep(0))
+            finally:
+                loop.close()
+
+            # The cleanup kept the entries, the compaction shrunk them
+            assert len(rl) == 5
+            for key in range(5):
+                assert rl._entries[key].__getstate__()[3] == 10
+                assert rl.get_many([key]) == [(True, 99, 0)]
+
+    def test_instrumentation(self):
+        rl = Ratelimit(10, 10)
+
+        rl.hit("foo")
+        assert rl._hit_histogram.count == 0
+
+        rl._instrumented = True
+        rl.hit("foo")
+        rl.hit_many(["foo", "bar"])
+        rl.get_many(["foo"])
+        rl.cleanup()
+        rl.compact(10)
+
+        assert rl._hit_histogram.count == 3
+        assert rl._hit_histogram.max > 0
+        assert rl._cleanup_histogram.count == 2
+
+        # Table calls can be sampled, cleanups are all timed
+        rl._sample = 4
+        for _ in range(40):
+            rl.hit("bar")
+        rl.cleanup()
+
+        assert rl._hit_histogram.count == 3 + 10
+        assert rl._cleanup_histogram.count == 3
+
+    def test_reconfigure_count(self):
+        rl = Ratelimit(2, 10, block_size=1)
+
+        def csize(key):
+            return rl._entries[key].__getstate__()[3]
+
+        with FakeTime() as fake:
+            for key in ("foo", "bar"):
+                assert rl.hit(key) is True
+                fake += 1000
+                assert rl.hit(key) is True
+                fake += 1000
+                assert rl.hit(key) is False
+
+            # More hits allowed, without losing the previous ones
+            rl.reconfigure(4, 10)
+            assert rl.count == 4
+            assert csize("foo") == 2  # Not resized yet
+
+            assert rl.hit("foo") is True
+            assert rl.hit("foo") is True
+            assert rl.hit("foo") is False
+            assert csize("foo") == 4
+
+            # Less hits allowed, the most recent ones are kept
+            rl.reconfigure(3, 10)
+            assert rl.get_many(["foo", "bar"]) == [(True, 0, 7000), (True, 1, 0)]
+            assert csize("foo") == 3
+            assert csize("bar") == 2
+
+            fake += 7000
+            assert rl.hit("foo") is True
+            assert rl.hit("foo") is False
+
+            # Compaction resizes the entries too
+            rl.reconfigure(1, 10)
+            assert rl.compact(10) == (2, 2)
+            assert csize("foo") == csize("bar") == 1
+            assert rl.next_hit("bar") == 2000
+
+    def test_reconfigure_period(self):
+        rl = Ratelimit(2, 10)
+
+        with FakeTime() as fake:
+            rl.hit("foo")
+            fake += 3000
+            rl.hit("foo")
+            assert rl.hit("foo") is False
+
+            rl.reconfigure(2, 5)
+            assert rl.period == 5.0
+            assert rl.next_hit("foo") == 2000
+
+            # The first hit is older than the new period
+            fake += 2000
+            assert rl.get_many(["foo"]) == [(True, 1, 0)]
+            assert rl.hit("foo") is True
+            assert rl.hit("foo") is False
+
+        with self.assertRaises(ValueError):
+            rl.reconfigure(0, 5)
+
+        # The bound is the same for the constructor and reconfigure
+        rl.reconfigure(1, 86400 * 24)
+        assert rl.period == 86400 * 24.0
+        assert Ratelimit(1, 86400 * 24).period == 86400 * 24.0
+
+        with self.assertRaisesRegex(ValueError, "maximum period is 24 days"):
+            rl.reconfigure(1, 86400 * 25)
+
+        with self.assertRaisesRegex(ValueError, "maximum period is 24 days"):
+            Ratelimit(1, 86400 * 25)
+
+        with self.assertRaisesRegex(ValueError, "maximum count"):
+            rl.reconfigure(2**31, 5)
+
+
+def test_histogram():
+    histogram = Histogram()
+    assert histogram.value_at(50) == 0
+
+    for value in range(1, 100001):
+        histogram.record(value * 1000)
+
+    assert histogram.count == 100000
+    assert histogram.min == 1000
+    assert histogram.max == 100000000
+    assert histogram.total == sum(range(1, 100001)) * 1000
+
+    # Values are known within 1.6%
+    for percentile in (1, 50, 90, 99, 99.9):
+        expected = percentile * 1000000
+        assert expected <= histogram.value_at(percentile) <= expected * 1.016
+    assert histogram.value_at(100) == histogram.max
+
+    # Exact below 128
+    histogram.reset()
+    for value in range(128):
+        histogram.record(value)
+    assert histogram.value_at(50) == 63
+
+    with pytest.raises(ValueError):
+        histogram.value_at(101)
+
+    with pytest.raises(OverflowError):
+        histogram.record(-1)
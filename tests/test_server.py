@@ -1,8 +1,14 @@
 import asyncio
+import socket
+import subprocess
+import sys
+import time
 
 import pytest
 
-from pyrated.server import amain, parse_args
+from pyrated.protocol import UDP_HEADER, MemcachedServerProtocol
+from pyrated.ratelimit import Ratelimit
+from pyrated.server import amain, parse_args, unix_address
 
 
 def test_no_args(capsys):
@@ -98,3 +104,303 @@ async def test_server_main(unused_tcp_port):
 
         task.cancel()
         await task
+
+
+def test_loop_default():
+    args = parse_args(["1/1"])
+    assert args.loop == "asyncio"
+
+
+def test_loop_selector():
+    args = parse_args(["1/1", "--loop", "selector"])
+    assert args.loop == "selector"
+
+
+def test_server_uvloop(unused_tcp_port, unused_udp_port):
+    pytest.importorskip("uvloop")
+
+    port = unused_tcp_port
+    process = subprocess.Popen(
+        [sys.executable, "-m", "pyrated.server", "1/1", "--loop", "uvloop"]
+        + ["-s", "127.0.0.1", "-p", str(port), "-U", str(unused_udp_port)],
+        stdout=subprocess.DEVNULL,
+    )
+
+    try:
+        deadline = time.monotonic() + 5
+        while True:
+            try:
+                sock = socket.create_connection(("127.0.0.1", port))
+                break
+            except ConnectionRefusedError:
+                assert time.monotonic() < deadline
+                time.sleep(0.02)
+
+        with sock:
+            sock.sendall(b"incr hello\r\nincr hello\r\n")
+            data = b""
+            while len(data) < 6:
+                data += sock.recv(8)
+            assert data == b"0\r\n1\r\n"
+
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as udp:
+            udp.settimeout(1)
+            udp.sendto(
+                UDP_HEADER.pack(5, 0, 1, 0) + b"incr hello\r\n",
+                ("127.0.0.1", unused_udp_port),
+            )
+            assert udp.recv(1500) == UDP_HEADER.pack(5, 0, 1, 0) + b"1\r\n"
+    finally:
+        process.terminate()
+        process.wait()
+
+    assert process.returncode == 0
+
+
+def test_loop_invalid(capsys):
+    with pytest.raises(SystemExit):
+        parse_args(["1/1", "--loop", "foo"])
+
+    assert "invalid choice" in capsys.readouterr().err
+
+
+def test_unix():
+    args = parse_args(["1/1", "-u", "/tmp/pyrated.sock", "--unix", "@pyrated"])
+    assert args.unix == ["/tmp/pyrated.sock", "@pyrated"]
+
+    # No TCP listener unless explicitly asked
+    assert args.source == []
+
+
+def test_unix_and_source():
+    args = parse_args(["1/1", "-u", "/tmp/pyrated.sock", "-s", "::1"])
+    assert args.unix == ["/tmp/pyrated.sock"]
+    assert args.source == ["::1"]
+
+
+def test_unix_address():
+    assert unix_address("/tmp/pyrated.sock") == "/tmp/pyrated.sock"
+    assert unix_address("@pyrated") == "\0pyrated"
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("abstract", [False, True])
+async def test_server_unix(tmp_path, abstract):
+    if abstract:
+        path = "@pyrated-test-%s" % tmp_path.name
+    else:
+        path = str(tmp_path / "pyrated.sock")
+    args = parse_args(["1/1", "-u", path])
+
+    task = asyncio.create_task(amain(args))
+    async with asyncio.timeout(1):
+        await asyncio.sleep(0.05)
+
+        reader, writer = await asyncio.open_unix_connection(unix_address(path))
+
+        writer.write(b"incr hello\r\n")
+        res = await reader.read(8)
+        assert res == b"0\r\n"
+
+        writer.write(b"incr hello\r\n")
+        res = await reader.read(8)
+        assert res == b"1\r\n"
+        writer.close()
+
+        task.cancel()
+        await task
+
+    assert not (tmp_path / "pyrated.sock").exists()
+
+
+def test_udp_requires_source(capsys):
+    with pytest.raises(SystemExit):
+        parse_args(["1/1", "-u", "/tmp/pyrated.sock", "-U", "11211"])
+
+    assert "UDP requires at least one source" in capsys.readouterr().err
+
+
+@pytest.mark.asyncio
+async def test_server_udp(unused_tcp_port, unused_udp_port):
+    args = parse_args(
+        ["1/1", "-s", "127.0.0.1", "-p", str(unused_tcp_port)]
+        + ["-U", str(unused_udp_port)]
+    )
+
+    task = asyncio.create_task(amain(args))
+    async with asyncio.timeout(1):
+        await asyncio.sleep(0.05)
+
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setblocking(False)
+        sock.connect(("127.0.0.1", unused_udp_port))
+        loop = asyncio.get_running_loop()
+
+        sock.send(UDP_HEADER.pack(5, 0, 1, 0) + b"incr hello\r\n")
+        assert (
+            await loop.sock_recv(sock, 1500) == UDP_HEADER.pack(5, 0, 1, 0) + b"0\r\n"
+        )
+
+        sock.send(UDP_HEADER.pack(6, 0, 1, 0) + b"incr hello\r\n")
+        assert (
+            await loop.sock_recv(sock, 1500) == UDP_HEADER.pack(6, 0, 1, 0) + b"1\r\n"
+        )
+
+        # Shared with TCP
+        reader, writer = await asyncio.open_connection("127.0.0.1", unused_tcp_port)
+        writer.write(b"incr hello\r\n")
+        assert await reader.read(8) == b"1\r\n"
+        writer.close()
+        sock.close()
+
+        task.cancel()
+        await task
+
+
+@pytest.mark.asyncio
+async def test_slow_reader(unused_tcp_port):
+    protocols = []
+    base = MemcachedServerProtocol.create_class(
+        Ratelimit(10, 1), write_high_water=4096, write_low_water=1024
+    )
+
+    class TrackedProtocol(base):
+        def connection_made(self, transport):
+            sock = transport.get_extra_info("socket")
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 4096)
+            protocols.append(self)
+            super().connection_made(transport)
+
+    loop = asyncio.get_running_loop()
+    server = await loop.create_server(TrackedProtocol, "127.0.0.1", unused_tcp_port)
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+    sock.connect(("127.0.0.1", unused_tcp_port))
+    reader, writer = await asyncio.open_connection(sock=sock)
+
+    count = 100000
+    writer.write(b"incr foo\r\n" * count)
+
+    async with asyncio.timeout(5):
+        # The client does not read, the server stops once its buffer is full
+        while not (protocols and protocols[0].write_paused):
+            await asyncio.sleep(0.01)
+
+        (protocol,) = protocols
+        assert protocol.transport.get_write_buffer_size() <= 4096 + 3
+        assert not protocol.transport.is_reading()
+
+        data = await reader.readexactly(count * 3)
+        assert data.startswith(b"0\r\n" * 10 + b"1\r\n")
+        assert not protocol.pending
+
+    writer.close()
+    server.close()
+
+
+def test_backpressure_defaults():
+    args = parse_args(["1/1"])
+    assert args.read_budget == MemcachedServerProtocol.read_budget
+    assert args.write_high_water == MemcachedServerProtocol.write_high_water
+    assert args.write_low_water == MemcachedServerProtocol.write_low_water
+
+
+def test_backpressure_options():
+    args = parse_args(
+        ["1/1", "--read-budget", "10"]
+        + ["--write-high-water", "2048", "--write-low-water", "512"]
+    )
+    assert args.read_budget == 10
+    assert args.write_high_water == 2048
+    assert args.write_low_water == 512
+
+
+def test_backpressure_invalid(capsys):
+    with pytest.raises(SystemExit):
+        parse_args(["1/1", "--write-high-water", "10", "--write-low-water", "20"])
+
+    assert "write low water" in capsys.readouterr().err
+
+    with pytest.raises(SystemExit):
+        parse_args(["1/1", "--read-budget", "0"])
+
+    assert "read budget" in capsys.readouterr().err
+
+
+def test_key_hash():
+    args = parse_args(["1/1"])
+    assert args.key_hash is False
+    assert args.key_seed == 0
+
+    args = parse_args(["1/1", "--key-hash"])
+    assert args.key_hash is True
+    assert args.key_seed != parse_args(["1/1", "--key-hash"]).key_seed
+
+
+@pytest.mark.asyncio
+async def test_server_stats(unused_tcp_port):
+    port = unused_tcp_port
+    args = parse_args(["1/1", "-s", "localhost", "-p", str(port), "--stats"])
+    assert args.stats is True
+
+    task = asyncio.create_task(amain(args))
+    async with asyncio.timeout(1):
+        await asyncio.sleep(0.25)
+
+        reader, writer = await asyncio.open_connection("localhost", port)
+        writer.write(b"incr hello\r\nstats detail\r\n")
+        res = await reader.readuntil(b"END\r\n")
+        writer.close()
+
+        assert b"STAT cmd_incr:count 1\r\n" in res
+        assert b"STAT loop_lag:count " in res
+
+        task.cancel()
+        await task
+
+
+def test_lazy_imports():
+    # Slow imports are only done when needed, for a fast startup
+    code = (
+        "import sys, pyrated.ratelimit, pyrated.server\n"
+        "slow = {'asyncio', 'argparse', 'importlib.metadata', 'typing'}\n"
+        "assert not slow & set(sys.modules), slow & set(sys.modules)\n"
+    )
+    subprocess.run([sys.executable, "-c", code], check=True)
+
+
+def test_version():
+    import pyrated
+
+    assert pyrated.__version__.count(".") == 2
+
+    with pytest.raises(AttributeError):
+        pyrated.foo
+
+
+def test_admin():
+    assert parse_args(["1/1"]).admin is False
+    assert parse_args(["1/1", "--admin"]).admin is True
+
+
+def test_cluster(capsys):
+    args = parse_args(["1/1"])
+    assert args.cluster is None
+    assert args.node is None
+
+    args = parse_args(
+        ["1/1", "--cluster", "127.0.0.1:11211", "--cluster", "[::1]:11212"]
+        + ["--node", "1"]
+    )
+    assert args.cluster == [("127.0.0.1", 11211), ("::1", 11212)]
+    assert args.node == 1
+
+    for invalid in (["--node", "0"], ["--cluster", "127.0.0.1:11211"]):
+        with pytest.raises(SystemExit):
+            parse_args(["1/1"] + invalid)
+
+        assert "--node" in capsys.readouterr().err
+
+    with pytest.raises(SystemExit):
+        parse_args(["1/1", "--cluster", "127.0.0.1:11211", "--node", "1"])
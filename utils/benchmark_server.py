@@ -0,0 +1,96 @@
+"""
+Compare the server throughput with the different --loop implementations
+
+Each mode is started in a subprocess and receives the same workload:
+request/reply incr calls, then pipelined batches of incr calls, both
+over TCP and over an unix socket
+
+Extra arguments are given to the servers, for example --stats to measure
+the overhead of the instrumentation
+"""
+import socket
+import subprocess
+import sys
+from time import sleep, time
+
+PORT = 11299
+UNIX = "/tmp/pyrated-benchmark.sock"
+C = 50000  # requests per workload
+B = 100  # pipeline batch size
+KEYS = tuple(("1.2.3.%d" % i).encode() for i in range(1000))
+EXTRA = sys.argv[1:]
+
+
+def connect(transport):
+    if transport == "unix":
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(UNIX)
+        return sock
+
+    sock = socket.create_connection(("127.0.0.1", PORT))
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    return sock
+
+
+def start(loop, transport):
+    if transport == "unix":
+        listen = ["-u", UNIX]
+    else:
+        listen = ["-s", "127.0.0.1", "-p", str(PORT)]
+
+    proc = subprocess.Popen(
+        [sys.executable, "-m", "pyrated.server", "--loop", loop, "10/1"] + listen + EXTRA,
+        stdout=subprocess.DEVNULL,
+    )
+    for _ in range(100):
+        try:
+            return proc, connect(transport)
+        except (ConnectionRefusedError, FileNotFoundError):
+            sleep(0.05)
+    proc.kill()
+    raise RuntimeError("server did not start")
+
+
+def recv_lines(sock, count):
+    data = b""
+    while data.count(b"\n") < count:
+        data += sock.recv(65536)
+
+
+def request_reply(sock):
+    s = time()
+    for i in range(C):
+        sock.sendall(b"incr " + KEYS[i % len(KEYS)] + b"\r\n")
+        recv_lines(sock, 1)
+    return time() - s
+
+
+def pipelined(sock):
+    batch = b"".join(b"incr " + KEYS[i % len(KEYS)] + b"\r\n" for i in range(B))
+    s = time()
+    for i in range(C // B):
+        sock.sendall(batch)
+        recv_lines(sock, B)
+    return time() - s
+
+
+try:
+    import uvloop  # noqa: F401
+
+    LOOPS = ("asyncio", "uvloop", "selector")
+except ImportError:
+    LOOPS = ("asyncio", "selector")
+
+for loop in LOOPS:
+    for transport in ("tcp", "unix"):
+        name = "%s/%s" % (loop, transport)
+        proc, sock = start(loop, transport)
+        try:
+            d = request_reply(sock)
+            print('%-14s request/reply, %d loops: %.3fs (%d/s)' % (name, C, d, C / d))
+            d = pipelined(sock)
+            print('%-14s pipelined by %d, %d loops: %.3fs (%d/s)' % (name, B, C, d, C / d))
+        finally:
+            sock.close()
+            proc.terminate()
+            proc.wait()
@@ -0,0 +1,72 @@
+"""
+Measure the startup time of pyrated: import time of the modules, and time
+until the server accepts connections with the different --loop
+implementations
+
+Times are the median of several runs, "python -c pass" being the reference
+(interpreter startup)
+"""
+import os
+import socket
+import subprocess
+import sys
+from statistics import median
+from time import perf_counter, sleep
+
+RUNS = 10
+UNIX = "/tmp/pyrated-startup.sock"
+
+
+def run_time(statement):
+    times = []
+    for _ in range(RUNS):
+        s = perf_counter()
+        subprocess.run([sys.executable, "-c", statement], check=True)
+        times.append(perf_counter() - s)
+    return median(times)
+
+
+def listening_time(loop):
+    times = []
+    for _ in range(RUNS):
+        s = perf_counter()
+        proc = subprocess.Popen(
+            [sys.executable, "-m", "pyrated.server", "--loop", loop, "-u", UNIX, "10/1"],
+            stdout=subprocess.DEVNULL,
+        )
+        try:
+            while True:
+                sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                try:
+                    sock.connect(UNIX)
+                    break
+                except (ConnectionRefusedError, FileNotFoundError):
+                    sleep(0.0005)
+                finally:
+                    sock.close()
+            times.append(perf_counter() - s)
+        finally:
+            proc.terminate()
+            proc.wait()
+            if os.path.exists(UNIX):
+                os.unlink(UNIX)
+    return median(times)
+
+
+base = run_time("pass")
+print('%-32s %.1fms' % ('python -c pass', base * 1000))
+
+for module in ("pyrated", "pyrated.ratelimit", "pyrated.server"):
+    d = run_time("import %s" % module)
+    print('%-32s %.1fms (+%.1fms)' % ('import ' + module, d * 1000, (d - base) * 1000))
+
+try:
+    import uvloop  # noqa: F401
+
+    LOOPS = ("asyncio", "uvloop", "selector")
+except ImportError:
+    LOOPS = ("asyncio", "selector")
+
+for loop in LOOPS:
+    d = listening_time(loop)
+    print('%-32s %.1fms (+%.1fms)' % ('listening, --loop ' + loop, d * 1000, (d - base) * 1000))
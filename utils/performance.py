@@ -6,7 +6,7 @@ import sys
 from itertools import cycle
 
 from time import time, sleep
-from pyrated.ratelimit import Ratelimit
+from pyrated.ratelimit import Ratelimit, key_hash
 
 
 C = 3000000
@@ -64,3 +64,38 @@ for k in IKEYS:
     r.hit(k)
 d = time() - s
 print('%d keys, %d entries, %d loops: %.3fs (%d/s)' % (len(KEYS), N, len(IKEYS), d, len(IKEYS) / d)) 
+
+KEYS = tuple('1.2.3.%d' % i for i in range(10))
+GETS = int(C / 10 / len(KEYS))
+N = 100
+r = Ratelimit(N, D)
+r.hit_many(KEYS * 50)
+s = time()
+for i in range(GETS):
+    [(k, r.next_hit(k)) for k in KEYS if k in r]
+d = time() - s
+print('get %d keys, contains + next_hit, %d loops: %.3fs (%d/s)' % (len(KEYS), GETS, d, GETS / d))
+
+s = time()
+for i in range(GETS):
+    r.get_many(KEYS)
+d = time() - s
+print('get %d keys, get_many, %d loops: %.3fs (%d/s)' % (len(KEYS), GETS, d, GETS / d))
+
+# Keys as received by the server: a new string object each time
+KEYS = tuple(b'https://example.com/api/v1/resource/%d?token=%s' % (i, b'x' * 200) for i in range(50000))
+IKEYS = KEYS * int(C/len(KEYS))
+N = 10
+r = Ratelimit(N, D)
+s = time()
+for k in IKEYS:
+    r.hit(k.decode())
+d = time() - s
+print('%d long keys, %d entries, %d loops: %.3fs (%d/s)' % (len(KEYS), N, len(IKEYS), d, len(IKEYS) / d))
+
+r = Ratelimit(N, D)
+s = time()
+for k in IKEYS:
+    r.hit(key_hash(k.decode(), 42))
+d = time() - s
+print('%d long keys hashed, %d entries, %d loops: %.3fs (%d/s)' % (len(KEYS), N, len(IKEYS), d, len(IKEYS) / d))
@@ -0,0 +1,43 @@
+"""
+Memory allocations with large limits and short lived keys
+
+Each round hits new keys up to their limit, then time goes by a period and
+a cleanup removes them all
+"""
+from time import time
+
+from pyrated._ratelimit import _set_fake_now
+from pyrated.ratelimit import Ratelimit
+
+R = 20  # rounds
+K = 2000  # keys per round
+N = 1000  # limit
+D = 60
+
+for growth in (1.0, 2.0):
+    try:
+        r = Ratelimit(N, D, growth=growth)
+    except TypeError:  # before growth/pool were introduced
+        r = Ratelimit(N, D)
+
+    now = 1000
+    s = time()
+    for i in range(R):
+        _set_fake_now(now)
+        for k in range(K):
+            r.hit_many(['%d-%d' % (i, k)] * 10)
+            for _ in range(N // 10 - 1):
+                r.hit_many(['%d-%d' % (i, k)] * 10)
+        now += D * 1000
+        _set_fake_now(now)
+        r.cleanup()
+    d = time() - s
+    _set_fake_now(0)
+
+    hits = R * K * N
+    print('growth %.1f, %d rounds of %d keys, %d hits: %.3fs (%d/s)' % (growth, R, K, hits, d, hits / d))
+
+    stats = getattr(r, '_pool_stats', dict)()
+    if stats:
+        print('  rings allocated: %(allocated)d, reused: %(reused)d, '
+              'freed: %(freed)d, cached: %(cached)d' % stats)
@@ -0,0 +1,38 @@
+"""
+Hit throughput from a pool of threads (distinct keys per thread)
+
+Only scales on free-threaded builds (python 3.13t+), with the GIL the
+total throughput stays roughly the same whatever the number of threads
+"""
+import sys
+import threading
+from time import time
+
+from pyrated.ratelimit import Ratelimit
+
+C = 1000000  # hits per thread
+N = 100
+D = 1000
+
+gil = getattr(sys, '_is_gil_enabled', lambda: True)()
+print('GIL enabled: %s' % gil)
+
+for T in (1, 2, 4, 8):
+    r = Ratelimit(N, D)
+    KEYS = tuple('10.0.%d.%d' % (t, i) for t in range(T) for i in range(100))
+
+    def work(t):
+        keys = KEYS[t * 100:(t + 1) * 100]
+        hit = r.hit
+        for i in range(C // 100):
+            for k in keys:
+                hit(k)
+
+    threads = [threading.Thread(target=work, args=(t,)) for t in range(T)]
+    s = time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    d = time() - s
+    print('%d threads, %d hits: %.3fs (%d/s)' % (T, C * T, d, C * T / d))